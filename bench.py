@@ -0,0 +1,392 @@
+"""
+Benchmarks for the hot paths of the library: counting (cpt.cpt), scoring
+(Network.jointprob, score.itlik), DSC parsing and harmony search.
+
+The import time of the core modules is measured as well, and --check-imports
+fails the run if it exceeds its budget or pulls in the plotting libraries or
+scipy (test_imports.py checks the same).
+
+Networks and datasets are synthetic and generated from a fixed seed, so runs
+with the same parameters are comparable.  Each benchmark runs in its own
+process so the peak memory reported is its own.  Results are written as JSON
+and can be compared against a stored baseline run:
+
+    python bench.py --rows 20000 --output base.json
+    python bench.py --rows 20000 --compare base.json
+
+--verify-shards N checks that counting N partitions in separate processes
+(through shard files) and merging them gives the single pass counts.
+"""
+
+import os
+import sys
+import time
+import json
+import tempfile
+import resource
+import argparse
+import subprocess
+import multiprocessing
+import numpy as N
+
+import network
+import cpt
+import score
+import dsc
+import harm
+
+def synthetic(nnodes=10, nstates=3, nparents=2, nrows=1000, seed=0):
+    """Generate a random network and a dataset sampled from it
+
+    Node i draws up to nparents parents among nodes 0..i-1, so the nodes are
+    already in topological order.  Each family gets a random CPT which is
+    stored on the node as 'cpt'.
+
+    PARAMETERS:
+        nnodes      number of nodes
+        nstates     number of states of each node
+        nparents    maximum number of parents of a node
+        nrows       number of rows in the dataset
+        seed        seed of the random generator
+
+    RETURNS:
+        net         instance of Network
+        data        dataset as numpy array
+    """
+    rand = N.random.RandomState(seed)
+    names = ["V{0}".format(i) for i in xrange(nnodes)]
+    net = network.Network(names)
+    for i, name in enumerate(names):
+        k = min(i, rand.randint(nparents+1))
+        parents = [names[p] for p in sorted(rand.permutation(i)[:k])]
+        net.add_edges_from([(p, name) for p in parents])
+        d = net.node[name]
+        d['nstates'] = nstates
+        d['ind_states'] = {s:"s{0}".format(s) for s in xrange(nstates)}
+        d['states_ind'] = {v:s for s, v in d['ind_states'].iteritems()}
+        d['cptdim'] = tuple(parents + [name])
+        d['cpt'] = rand.dirichlet(N.ones(nstates), size=nstates**k).reshape((nstates,)*(k+1))
+
+    #ancestral sampling, one node (column) at a time
+    data = N.zeros((nrows, nnodes), order='F')
+    for i, name in enumerate(names):
+        d = net.node[name]
+        pids = [net.graph['nilut'][p] for p in d['cptdim'][:-1]]
+        probs = d['cpt'].reshape((-1, nstates))
+        if pids:
+            rows = N.ravel_multi_index(tuple(data[:,pids].astype(int).T), d['cpt'].shape[:-1])
+        else:
+            rows = N.zeros(nrows, dtype=int)
+        cum = N.cumsum(probs[rows], axis=1)
+        data[:,i] = (rand.rand(nrows, 1) > cum).sum(axis=1).clip(0, nstates-1)
+
+    return net, data
+
+def write_dsc(net, filename, name="bench"):
+    """Write a network with cpt tables in the DSC format read by dsc.DSC_Parser"""
+    with open(filename, 'wb') as f:
+        f.write('belief network "{0}"\n'.format(name))
+        for node in net.ordering:
+            d = net.node[node]
+            values = ', '.join('"{0}"'.format(d['ind_states'][s]) for s in xrange(d['nstates']))
+            f.write('node {0} {{\n'.format(node))
+            f.write('  type : discrete [ {0} ] = {{ {1} }};\n'.format(d['nstates'], values))
+            f.write('}\n')
+        for node in net.ordering:
+            d = net.node[node]
+            parents = d['cptdim'][:-1]
+            table = d['cpt'].reshape((-1, d['nstates']))
+            if parents:
+                f.write('probability ( {0} | {1} ) {{\n'.format(node, ', '.join(parents)))
+                for index, vals in zip(N.ndindex(d['cpt'].shape[:-1]), table):
+                    f.write('  ({0}) : {1};\n'.format(', '.join(map(str, index)), ', '.join(map(repr, vals))))
+            else:
+                f.write('probability ( {0} ) {{\n'.format(node))
+                f.write('  {0};\n'.format(', '.join(map(repr, table[0]))))
+            f.write('}\n')
+
+################################################################################
+#Benchmarks
+#Each takes the benchmark parameters and returns a callable to time.
+################################################################################
+def _fresh(net):
+    """Copy of net without any cpt tables"""
+    fresh = net.copy()
+    for d in fresh.node.itervalues():
+        for key in ('cpt', 'cptdim', 'logcpt', 'logcpt_version', 'probcpt', 'probcpt_version'):
+            d.pop(key, None)
+    return fresh
+
+def _edgeless(net):
+    """Network over the nodes of net, without its edges, keeping the states"""
+    empty = network.Network(net.ordering)
+    for node, d in empty.node.iteritems():
+        d.update((k, v) for k, v in net.node[node].iteritems()
+                 if k in ('nstates', 'states_ind', 'ind_states'))
+    return empty
+
+def bench_cpt(params):
+    net, data = synthetic(**params)
+    return lambda: cpt.cpt(_fresh(net), data)
+
+def bench_cpt_sparse(params):
+    net, data = synthetic(**params)
+    return lambda: cpt.cpt(_fresh(net), data, sparse=True)
+
+def bench_jointprob(params):
+    net, data = synthetic(**params)
+    return lambda: net.jointprob(data)
+
+def bench_itlik(params):
+    net, data = synthetic(**params)
+    return lambda: score.itlik(net, data)
+
+def bench_dsc(params):
+    net, data = synthetic(**params)
+    fd, filename = tempfile.mkstemp(suffix='.dsc')
+    os.close(fd)
+    write_dsc(net, filename)
+    return lambda: dsc.DSC_Parser(filename)
+
+def bench_harmony(params):
+    net, data = synthetic(**params)
+    def run():
+        #edges of the start network are required, the true ones would be given
+        hs = harm.HarmonySearch(_edgeless(net), hms=10, maxiters=20)
+        hs.search(data, every=1000, amnesia=1000)
+    return run
+
+def _count_partition(args):
+    """Count one partition file into a shard file (in a worker process)"""
+    net, datafile, shardfile, sparse = args
+    cpt.save_shard(cpt.shard(net, N.load(datafile), sparse=sparse), net, shardfile)
+    return shardfile
+
+def verify_shards(params, nshards=4, sparse=False):
+    """Fit the synthetic data in nshards partitions and compare with one pass
+    
+    Each partition is written to its own file and counted by a separate
+    process, the shard files are merged and applied to a fresh network.
+
+    RETURNS:
+        problems    list of messages (empty if the counts match)
+    """
+    net, data = synthetic(**params)
+    net = _fresh(net)
+    for node in net.nodes():
+        net.node[node]['cptdim'] = tuple(sorted(net.pred[node])) + (node,)
+    whole = net.copy()
+    cpt.cpt(whole, data, sparse=sparse)
+
+    tmpdir = tempfile.mkdtemp()
+    jobs = []
+    for i, part in enumerate(N.array_split(data, nshards)):
+        datafile = os.path.join(tmpdir, "part{0}.npy".format(i))
+        N.save(datafile, part)
+        jobs.append((net, datafile, os.path.join(tmpdir, "part{0}.npz".format(i)), sparse))
+    pool = multiprocessing.Pool(min(nshards, multiprocessing.cpu_count()))
+    try:
+        shardfiles = pool.map(_count_partition, jobs)
+    finally:
+        pool.terminate()
+
+    merged = net.copy()
+    cpt.apply_shard(merged, cpt.merge_shards(cpt.load_shard(f, net) for f in shardfiles))
+
+    problems = []
+    for node in net.nodes():
+        a, b = whole.node[node], merged.node[node]
+        if a['cptdim'] != b['cptdim']:
+            problems.append("shards: {0} has family {1} != {2}".format(node, b['cptdim'], a['cptdim']))
+        elif sparse:
+            for key in ('keys', 'counts', 'pkeys', 'pcounts'):
+                if not N.array_equal(getattr(a['sparse'], key), getattr(b['sparse'], key)):
+                    problems.append("shards: {0} sparse {1} differ".format(node, key))
+        else:
+            for key in ('numer', 'denom'):
+                if not N.array_equal(a[key], b[key]):
+                    problems.append("shards: {0} {1} differ".format(node, key))
+    for f in os.listdir(tmpdir):
+        os.unlink(os.path.join(tmpdir, f))
+    os.rmdir(tmpdir)
+    return problems
+
+#seconds allowed to import the core modules, which must not import HEAVY_MODULES
+IMPORT_BUDGET = 1.0
+CORE_MODULES = ('network', 'cpt', 'score')
+HEAVY_MODULES = ('matplotlib', 'pydot', 'scipy')
+
+def import_time(modules=CORE_MODULES):
+    """Time the import of modules in a fresh interpreter
+
+    RETURNS:
+        seconds     import time
+        heavy       HEAVY_MODULES that got imported along
+    """
+    code = ("import sys, time, json; start = time.time(); import {0}; "
+            "print json.dumps([time.time() - start, sorted(m for m in {1!r} if m in sys.modules)])")
+    out = subprocess.check_output([sys.executable, '-c', code.format(', '.join(modules), HEAVY_MODULES)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(out.strip().splitlines()[-1])
+
+def check_imports(result, budget=IMPORT_BUDGET):
+    """Problems with an import_time result (list of messages)"""
+    problems = []
+    if result['time'] > budget:
+        problems.append("import: {0:.3f}s exceeds the budget of {1:.3f}s".format(result['time'], budget))
+    if result['heavy']:
+        problems.append("import: core modules import {0}".format(', '.join(result['heavy'])))
+    return problems
+
+BENCHMARKS = [
+    ('cpt', bench_cpt),
+    ('cpt_sparse', bench_cpt_sparse),
+    ('jointprob', bench_jointprob),
+    ('itlik', bench_itlik),
+    ('dsc', bench_dsc),
+    ('harmony', bench_harmony),
+]
+
+def _run_one(args):
+    """Run one benchmark (in a worker process)"""
+    name, params, repeat = args
+    setup = dict(BENCHMARKS)[name]
+    try:
+        func = setup(params)
+        startrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for i in xrange(repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except Exception as e:
+        return name, {'error': "{0}: {1}".format(type(e).__name__, e)}
+
+    return name, {'time': sorted(times)[len(times)//2],
+                  'times': times,
+                  'maxrss_kb': maxrss,
+                  'setup_maxrss_kb': startrss}
+
+def run(params, names=None, repeat=3):
+    """Run the benchmarks, each in a fresh process
+
+    PARAMETERS:
+        params      synthetic() parameters
+        names       benchmarks to run (default all)
+        repeat      number of timed runs of each benchmark
+
+    RETURNS:
+        dict        machine-readable results
+    """
+    names = names or [name for name, setup in BENCHMARKS]
+    results = {}
+    for name in names:
+        pool = multiprocessing.Pool(1)
+        try:
+            key, result = pool.apply(_run_one, ((name, params, repeat),))
+        finally:
+            pool.terminate()
+        results[key] = result
+
+    seconds, heavy = import_time()
+    results['import'] = {'time': seconds, 'heavy': heavy}
+
+    return {'params': params,
+            'repeat': repeat,
+            'python': sys.version.split()[0],
+            'numpy': N.__version__,
+            'results': results}
+
+#memory growth (KB) below which a hot path never counts as a regression
+RSS_SLACK_KB = 1024
+
+def _hot_rss(result):
+    """Peak memory (KB) added by the runs of a benchmark over its setup"""
+    if 'maxrss_kb' not in result or 'setup_maxrss_kb' not in result:
+        return None
+    return result['maxrss_kb'] - result['setup_maxrss_kb']
+
+def compare(current, baseline, tolerance=.25):
+    """Compare two runs.  Returns a list of regression messages
+
+    A benchmark regresses if its median time or the peak memory its runs
+    added on top of its setup (generating the network and data) exceeds the
+    baseline by more than tolerance (a fraction) and, for memory, by more
+    than RSS_SLACK_KB.
+    """
+    regressions = []
+    if current['params'] != baseline['params']:
+        regressions.append("parameters differ from the baseline: {0} != {1}".format(current['params'], baseline['params']))
+    for name, result in sorted(current['results'].iteritems()):
+        base = baseline['results'].get(name, None)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            regressions.append("{0}: {1}".format(name, result['error']))
+            continue
+        if 'time' in result and 'time' in base:
+            if result['time'] > base['time']*(1.0 + tolerance):
+                regressions.append("{0}: time {1:.4g} > baseline {2:.4g}".format(name, result['time'], base['time']))
+        hot, basehot = _hot_rss(result), _hot_rss(base)
+        if hot is not None and basehot is not None:
+            if hot > basehot*(1.0 + tolerance) and hot - basehot > RSS_SLACK_KB:
+                regressions.append("{0}: hot maxrss_kb {1:.4g} > baseline {2:.4g}".format(name, hot, basehot))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bnet hot paths")
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--states', type=int, default=3)
+    parser.add_argument('--parents', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', choices=[name for name, setup in BENCHMARKS])
+    parser.add_argument('--output', help="write the results (JSON) to this file")
+    parser.add_argument('--compare', help="baseline results (JSON) to compare against")
+    parser.add_argument('--tolerance', type=float, default=.25)
+    parser.add_argument('--check-imports', action='store_true',
+                        help="fail if importing the core modules exceeds --import-budget")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET)
+    parser.add_argument('--verify-shards', type=int, metavar='N',
+                        help="check that N merged count shards match a single pass fit")
+    args = parser.parse_args(argv)
+
+    params = {'nnodes': args.nodes, 'nstates': args.states, 'nparents': args.parents,
+              'nrows': args.rows, 'seed': args.seed}
+    results = run(params, args.only, args.repeat)
+
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(out)
+    else:
+        print out
+
+    status = 0
+    if args.check_imports:
+        problems = check_imports(results['results']['import'], args.import_budget)
+        for p in problems:
+            print >>sys.stderr, "IMPORT", p
+        status = 1 if problems else status
+
+    if args.verify_shards:
+        problems = []
+        for sparse in (False, True):
+            problems.extend(verify_shards(params, args.verify_shards, sparse))
+        for p in problems:
+            print >>sys.stderr, "SHARDS", p
+        status = 1 if problems else status
+
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print >>sys.stderr, "REGRESSION", r
+        status = 1 if regressions else status
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
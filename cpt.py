@@ -1,6 +1,578 @@
 import numpy as N
+import instrument
 
-def cpt(net, data, nodes=None, bias=0.0):
+#log probability used in place of log(0) for zero or unseen probabilities
+LOGTINY = N.log(N.finfo(float).tiny)
+
+#state index of a missing value
+MISSING = -1
+
+#largest number of joint completions of a component of missing cells that
+#marginalization (Network.logprob, em.em) enumerates, the families of larger
+#components are left out (see marginal_plan)
+MAX_COMPLETIONS = 2**20
+
+#compact mode (see set_compact): unsigned state codes, uint32 counts and
+#float32 log probability tables and scores
+COMPACT = False
+
+def set_compact(on=True):
+    """Turn the compact dtype mode on or off
+    
+    In compact mode datasets are loaded as the smallest unsigned integers
+    holding all state codes (missing values become the largest value of the
+    dtype, see compact_states), dense counts are uint32 while they cannot
+    overflow, and log probability tables and log probability sums are
+    float32.  Log probabilities then agree with float64 to about 1e-6
+    relative (float32 rounding of each term and of the running sum).
+    """
+    global COMPACT
+    COMPACT = bool(on)
+    
+def float_dtype():
+    """dtype of log probability tables and scores"""
+    return N.float32 if COMPACT else float
+    
+def compact_states(data, nstates=None):
+    """Store state codes in the smallest unsigned dtype
+    
+    PARAMETERS:
+        data        dataset with missing values encoded as MISSING
+        nstates     largest number of states of a column (default from data)
+        
+    RETURNS:
+        ndarray     same shape and memory order as data.  Missing values
+                    are the largest value of the dtype.
+    """
+    data = N.asarray(data)
+    if nstates is None:
+        nstates = int(data.max()) + 1 if data.size else 1
+    for dtype in (N.uint8, N.uint16, N.uint32):
+        #the largest value is the missing sentinel
+        if nstates < N.iinfo(dtype).max:
+            break
+    else:
+        dtype = N.uint64
+    out = N.empty(data.shape, dtype=dtype, order='F' if N.isfortran(data) else 'C')
+    out[...] = N.where(data == MISSING, N.iinfo(dtype).max, data)
+    return out
+    
+def as_states(data):
+    """State codes as int64 with missing values as MISSING (undoes compact_states)"""
+    data = N.asarray(data)
+    states = data.astype(N.int64)
+    if data.dtype.kind == 'u':
+        states[data == N.iinfo(data.dtype).max] = MISSING
+    return states
+    
+def is_missing(data):
+    """Boolean mask of the missing cells of a (possibly compact) dataset"""
+    data = N.asarray(data)
+    if data.dtype.kind == 'u':
+        return data == N.iinfo(data.dtype).max
+    return data == MISSING
+
+def _gather(keys, values, query, out):
+    """Write the values of query keys found in the sorted key array keys
+    into out.  Entries of out for unseen keys are left untouched.
+    """
+    if keys.size == 0:
+        return out
+    idx = N.searchsorted(keys, query)
+    idx[idx == keys.size] = 0
+    hit = keys[idx] == query
+    out[hit] = values[idx[hit]]
+    return out
+
+def _lookup(keys, counts, query):
+    """Gather the counts of query keys from a sorted key array.
+    Keys that have not been observed get a count of 0.
+    """
+    return _gather(keys, counts, query, N.zeros(query.shape, dtype=counts.dtype))
+
+def _merge(keys, counts, newkeys, newcounts):
+    """Merge two (key, count) tables into one sorted table"""
+    ukeys, inv = N.unique(N.concatenate((keys, newkeys)), return_inverse=True)
+    ucounts = N.bincount(inv, weights=N.concatenate((counts, newcounts)))
+    return ukeys, ucounts.astype(counts.dtype)
+
+def _pseudocounts(prior, alpha, shape):
+    """Pseudo-counts (per cell, per parent configuration) of a prior
+    
+    PARAMETERS:
+        prior       None (no smoothing), 'laplace' or 'bdeu'
+        alpha       pseudo-count per cell ('laplace') or the
+                    equivalent sample size ('bdeu')
+        shape       shape of the family table (child axis last)
+        
+    RETURNS:
+        (a_ijk, a_ij)
+    """
+    r = shape[-1]
+    q = int(N.prod(shape[:-1]))
+    if prior is None:
+        return 0., 0.
+    elif prior == 'laplace':
+        return float(alpha), float(alpha)*r
+    elif prior == 'bdeu':
+        return float(alpha)/(q*r), float(alpha)/q
+    else:
+        raise ValueError("Unknown prior: {0}".format(prior))
+
+def _dense_logtable(numer, denom, prior, alpha):
+    """Normalized log probability table from dense counts"""
+    a_ijk, a_ij = _pseudocounts(prior, alpha, numer.shape)
+    top = numer + a_ijk
+    bottom = denom + a_ij
+    table = N.empty(numer.shape, dtype=float_dtype())
+    table.fill(LOGTINY)
+    ok = (top > 0) & (bottom > 0)
+    table[ok] = N.log(top[ok]) - N.log(bottom[ok])
+    return table
+
+class SparseLogCPT(object):
+    """Normalized log probability table of a SparseCPT.
+    
+    Observed family configurations, observed parent configurations
+    (with an unobserved child state) and unobserved parent configurations
+    each have their own precomputed log probability, so a lookup is only
+    a gather.
+    """
+    
+    def __init__(self, table, prior=None, alpha=1.0):
+        a_ijk, a_ij = _pseudocounts(prior, alpha, table.shape)
+        self.encode = table.encode
+        self.nchild = table.shape[-1]
+        self.keys = table.keys
+        pcounts = _lookup(table.pkeys, table.pcounts, table.keys // self.nchild)
+        dtype = float_dtype()
+        self.values = (N.log(table.counts + a_ijk) - N.log(pcounts + a_ij)).astype(dtype)
+        self.pkeys = table.pkeys
+        if a_ijk > 0:
+            self.pvalues = (N.log(a_ijk) - N.log(table.pcounts + a_ij)).astype(dtype)
+            self.default = N.log(a_ijk) - N.log(a_ij)
+        else:
+            self.pvalues = N.empty(table.pkeys.shape, dtype=dtype)
+            self.pvalues.fill(LOGTINY)
+            self.default = LOGTINY
+            
+    def gather(self, states):
+        """Log probability of each family state (m, k array)"""
+        keys = self.encode(states)
+        out = N.empty(keys.shape, dtype=self.values.dtype)
+        out.fill(self.default)
+        _gather(self.pkeys, self.pvalues, keys // self.nchild, out)
+        return _gather(self.keys, self.values, keys, out)
+
+class SparseCPT(object):
+    """Count table that only stores the observed configurations of a family.
+    
+    Family configurations are flattened (child axis last) into integer keys.
+    keys/counts hold the observed family configurations, pkeys/pcounts the
+    observed parent configurations.  The parent counts are kept once instead
+    of being repeated along the child axis as in the dense denom table.
+    """
+    
+    def __init__(self, shape):
+        """
+        PARAMETERS:
+            shape       number of states of each variable in cptdim order
+        
+        RETURNS:
+            instance of SparseCPT
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.keys = N.zeros(0, dtype=N.int64)
+        self.counts = N.zeros(0, dtype=int)
+        self.pkeys = N.zeros(0, dtype=N.int64)
+        self.pcounts = N.zeros(0, dtype=int)
+        
+    def encode(self, states):
+        """Flatten an (m, k) array of family states into keys"""
+        states = N.atleast_2d(states).astype(N.int64)
+        return N.ravel_multi_index(tuple(states.T), self.shape)
+        
+    def update(self, states, weights=None):
+        """Add the family states in states (m, k array) to the counts,
+        each row counted weights[i] times if weights are given"""
+        keys, inv = N.unique(self.encode(states), return_inverse=True)
+        counts = N.bincount(inv, weights=weights).astype(int)
+        self.keys, self.counts = _merge(self.keys, self.counts, keys, counts)
+        
+        pkeys, inv = N.unique(keys // self.shape[-1], return_inverse=True)
+        pcounts = N.bincount(inv, weights=counts).astype(int)
+        self.pkeys, self.pcounts = _merge(self.pkeys, self.pcounts, pkeys, pcounts)
+        
+    def grow(self, axis, size):
+        """Enlarge the states of the variable on axis to size (new states
+        have no counts).  Keys are re-encoded, their order is unchanged."""
+        shape = list(self.shape)
+        shape[axis] = size
+        shape = tuple(shape)
+        self.keys = N.ravel_multi_index(N.unravel_index(self.keys, self.shape), shape).astype(N.int64)
+        if axis < len(shape) - 1:
+            self.pkeys = N.ravel_multi_index(N.unravel_index(self.pkeys, self.shape[:-1]), shape[:-1]).astype(N.int64)
+        self.shape = shape
+        
+    def merge(self, other):
+        """Add the counts of another SparseCPT of the same family"""
+        if other.shape != self.shape:
+            raise ValueError("Cannot merge tables of shapes {0} and {1}".format(self.shape, other.shape))
+        self.keys, self.counts = _merge(self.keys, self.counts, other.keys, other.counts)
+        self.pkeys, self.pcounts = _merge(self.pkeys, self.pcounts, other.pkeys, other.pcounts)
+        
+    def numer(self, states):
+        """Counts of the family states (m, k array)"""
+        return _lookup(self.keys, self.counts, self.encode(states))
+        
+    def denom(self, states):
+        """Counts of the parent configurations of the family states"""
+        return _lookup(self.pkeys, self.pcounts, self.encode(states) // self.shape[-1])
+        
+    def probs(self, states):
+        """Conditional probability of each family state (m, k array)
+        Parent configurations that were never observed get probability 0.
+        """
+        keys = self.encode(states)
+        top = _lookup(self.keys, self.counts, keys)
+        bottom = _lookup(self.pkeys, self.pcounts, keys // self.shape[-1])
+        probs = N.zeros(keys.shape)
+        seen = bottom > 0
+        probs[seen] = top[seen] / bottom[seen].astype(float)
+        return probs
+        
+    def prob(self, state):
+        """Conditional probability of a single family state (tuple)"""
+        return self.probs(N.atleast_2d(state))[0]
+        
+    def logtable(self, prior=None, alpha=1.0):
+        """Normalized log probability table (SparseLogCPT)"""
+        return SparseLogCPT(self, prior, alpha)
+
+def logcpt(net, node):
+    """Return the normalized log probability table of node.
+    
+    The table is built from the node's counts (sparse or numer/denom) with
+    the prior set by cpt(), or from an existing cpt table, and is cached on
+    the node.  It is only rebuilt when the node's counts have changed.
+    
+    PARAMETERS:
+        net     A Bayesian network
+        node    node label
+        
+    RETURNS:
+        table   ndarray in cptdim order or SparseLogCPT
+    """
+    d = net.node[node]
+    version = d.get('version', 0)
+    table = d.get('logcpt', None)
+    if table is not None and d.get('logcpt_version', None) == version:
+        instrument.cache('logcpt', True)
+        return table
+    instrument.cache('logcpt', False)
+    
+    prior, alpha = d.get('prior', (None, 1.0))
+    if 'sparse' in d:
+        table = d['sparse'].logtable(prior, alpha)
+    elif 'numer' in d and 'denom' in d:
+        table = _dense_logtable(d['numer'], d['denom'], prior, alpha)
+    elif 'cpt' in d:
+        probs = d['cpt']
+        table = N.empty(probs.shape, dtype=float_dtype())
+        table.fill(LOGTINY)
+        table[probs > 0] = N.log(probs[probs > 0])
+    else:
+        raise StandardError("No CPT table in node {0}".format(node))
+    
+    d['logcpt'] = table
+    d['logcpt_version'] = version
+    return table
+    
+def probcpt(net, node):
+    """Return the conditional probability table of node (numer/denom).
+    
+    Unlike logcpt no prior is applied: parent configurations without data
+    get probability 0.  The table is cached on the node and only rebuilt when
+    the node's version changes.  Sparse counts have no dense table, use
+    SparseCPT.probs instead.
+    
+    PARAMETERS:
+        net     A Bayesian network
+        node    node label
+        
+    RETURNS:
+        table   ndarray in cptdim order
+    """
+    d = net.node[node]
+    version = d.get('version', 0)
+    table = d.get('probcpt', None)
+    if table is not None and d.get('probcpt_version', None) == version:
+        instrument.cache('probcpt', True)
+        return table
+    instrument.cache('probcpt', False)
+    
+    if 'numer' in d and 'denom' in d:
+        numer, denom = d['numer'], d['denom']
+        table = N.zeros(numer.shape)
+        seen = denom > 0
+        table[seen] = numer[seen] / denom[seen].astype(float)
+    elif 'cpt' in d:
+        table = d['cpt']
+    else:
+        raise StandardError("No CPT table in node {0}".format(node))
+    
+    d['probcpt'] = table
+    d['probcpt_version'] = version
+    return table
+    
+def grow_states(net, node, nstates):
+    """Raise the number of states of node to nstates
+    
+    The count tables of every family node belongs to are enlarged: new
+    states start with no counts, and the parent counts (denom) of a new
+    child state are those of its parent configuration.
+    
+    PARAMETERS:
+        net         A Bayesian network
+        node        node label
+        nstates     new number of states
+        
+    RETURNS:
+        None
+    """
+    net.node[node]['nstates'] = nstates
+    for d in net.node.itervalues():
+        family = d.get('cptdim', ())
+        if node not in family:
+            continue
+        axis = list(family).index(node)
+        child = axis == len(family) - 1
+        if 'sparse' in d:
+            if d['sparse'].shape[axis] < nstates:
+                d['sparse'].grow(axis, nstates)
+        elif 'numer' in d and 'denom' in d:
+            extra = nstates - d['numer'].shape[axis]
+            if extra <= 0:
+                continue
+            pad = [(0, 0)] * d['numer'].ndim
+            pad[axis] = (0, extra)
+            denom = N.pad(d['denom'], pad, mode='constant')
+            if child and d['denom'].shape[axis] > 0:
+                denom[...,-extra:] = d['denom'][...,:1]
+            d['numer'] = N.pad(d['numer'], pad, mode='constant')
+            d['denom'] = denom
+        else:
+            continue
+        d.pop('cpt', None)
+        d['version'] = d.get('version', 0) + 1
+        
+def family_logprob(net, node, data):
+    """Log probability of node given its parents for every row of data
+    
+    PARAMETERS:
+        net     A Bayesian network
+        node    node label
+        data    A dataset (columns ordered by the network's lookup table)
+        
+    RETURNS:
+        ndarray     log probability of each row
+    """
+    nlut = net.graph['nilut']
+    table = logcpt(net, node)
+    states = as_states(data[:,[nlut[x] for x in net.node[node]['cptdim']]])
+    
+    #families with a missing state are left out (contribute 0)
+    missing = (states == MISSING).any(axis=1)
+    if missing.any():
+        states[missing] = 0
+    
+    if isinstance(table, SparseLogCPT):
+        logprobs = table.gather(states)
+    else:
+        logprobs = table[tuple(states.T)]
+    if missing.any():
+        logprobs[missing] = 0.
+    return logprobs
+    
+def missing_patterns(data):
+    """Group the rows of data by their pattern of missing values
+    
+    PARAMETERS:
+        data    A dataset
+        
+    RETURNS:
+        list    (columns, rows) pairs: the tuple of missing columns and the
+                indexes of the rows with exactly those columns missing.
+                Complete rows have an empty tuple of columns.
+    """
+    missing = is_missing(N.atleast_2d(data))
+    #one opaque key per row made of its packed missing flags
+    packed = N.ascontiguousarray(N.packbits(missing, axis=1))
+    keys = packed.view(N.dtype((N.void, packed.shape[1]))).ravel()
+    patterns, inv = N.unique(keys, return_inverse=True)
+    order = N.argsort(inv, kind='mergesort')
+    bounds = N.flatnonzero(N.diff(inv[order])) + 1
+    groups = []
+    for rows in N.split(order, bounds):
+        if rows.size:
+            groups.append((tuple(N.flatnonzero(missing[rows[0]])), rows))
+    return groups
+    
+def marginal_plan(net, cols, maxcompletions=MAX_COMPLETIONS):
+    """Split the families of net for rows missing the columns cols
+    
+    A missing node whose children are all barren sums out to 1 and is
+    barren itself, so only the other missing columns are enumerated.
+    Families without a relevant missing column are fully observed and are
+    scored once per row.  The relevant columns fall into components joined
+    by the families holding them, each component is summed out on its own.
+    Components with more than maxcompletions completions are dropped: their
+    families are left out, as logprob leaves out families with missing
+    cells.
+    
+    PARAMETERS:
+        net             A Bayesian network
+        cols            missing column (node) indexes
+        maxcompletions  largest number of completions of a component
+        
+    RETURNS:
+        fixed       nodes whose family is observed
+        components  list of (columns, nodes, number of completions): the
+                    relevant missing columns of a component and the nodes
+                    whose families hold them
+        dropped     the components over maxcompletions, same format
+    """
+    inlut = net.graph['inlut']
+    nilut = net.graph['nilut']
+    missing = set(inlut[c] for c in cols)
+    barren = set()
+    grown = True
+    while grown:
+        grown = False
+        for node in missing - barren:
+            if all(child in barren for child in net.succ[node]):
+                barren.add(node)
+                grown = True
+    unknown = missing - barren
+    
+    #relevant columns of the family of each node, nodes of each column
+    fixed = []
+    holds, held = {}, {}
+    for i in sorted(inlut):
+        node = inlut[i]
+        if node in barren:
+            continue
+        family = net.node[node].get('cptdim', tuple(net.pred[node]) + (node,))
+        ids = [nilut[x] for x in family if x in unknown]
+        if not ids:
+            fixed.append(node)
+            continue
+        holds[node] = ids
+        for c in ids:
+            held.setdefault(c, []).append(node)
+    
+    components, dropped = [], []
+    seen = set()
+    for c in cols:
+        if c not in held or c in seen:
+            continue
+        seen.add(c)
+        stack, members, nodes = [c], [], set()
+        while stack:
+            x = stack.pop()
+            members.append(x)
+            for node in held[x]:
+                if node in nodes:
+                    continue
+                nodes.add(node)
+                for y in holds[node]:
+                    if y not in seen:
+                        seen.add(y)
+                        stack.append(y)
+        members = tuple(sorted(members))
+        total = completion_count(net, members)
+        nodes = [inlut[i] for i in sorted(nilut[node] for node in nodes)]
+        if total <= maxcompletions:
+            components.append((members, nodes, total))
+        else:
+            dropped.append((members, nodes, total))
+    return fixed, components, dropped
+    
+def completion_count(net, cols):
+    """Number of joint assignments of states to the given columns"""
+    inlut = net.graph['inlut']
+    count = 1
+    for c in cols:
+        count *= int(net.node[inlut[c]]['nstates'])
+    return count
+    
+def completions(net, cols, start=0, stop=None):
+    """Joint assignments of states to the given columns
+    
+    Assignments are numbered in C order of the columns' states, start and
+    stop select a range of them so that large products can be enumerated a
+    chunk at a time.
+    
+    PARAMETERS:
+        net     A Bayesian network
+        cols    column (node) indexes
+        start   first assignment
+        stop    end of the assignments (default all of them)
+        
+    RETURNS:
+        ndarray     (stop - start, len(cols)) array of states
+    """
+    inlut = net.graph['inlut']
+    shape = [net.node[inlut[c]]['nstates'] for c in cols]
+    total = completion_count(net, cols)
+    stop = total if stop is None else min(stop, total)
+    return N.transpose(N.unravel_index(N.arange(start, stop), shape))
+    
+def complete_rows(states, cols, assignments):
+    """Fill the missing columns of rows with every assignment
+    
+    PARAMETERS:
+        states          (k, n) rows sharing the missing columns cols
+        cols            missing column indexes
+        assignments     (c, len(cols)) states for the missing columns
+                        (see completions)
+        
+    RETURNS:
+        ndarray         (k*c, n) rows, the c completions of each row in turn
+    """
+    c = assignments.shape[0]
+    expanded = N.repeat(states, c, axis=0)
+    expanded[:,list(cols)] = N.tile(assignments, (states.shape[0], 1))
+    return expanded
+    
+def completion_logprob(net, nodes, states, cols, assignments):
+    """Log probability of the families of nodes for every completion of rows
+    
+    PARAMETERS:
+        net             A Bayesian network
+        nodes           nodes whose families are scored (see marginal_plan)
+        states          (k, n) rows sharing the missing columns cols
+        cols            missing column indexes
+        assignments     (c, len(cols)) states for the missing columns
+        
+    RETURNS:
+        expanded        (k*c, n) completed rows (see complete_rows)
+        logp            (k, c) log probability of each completion of each row
+    """
+    expanded = complete_rows(states, cols, assignments)
+    logp = N.zeros(expanded.shape[0])
+    for node in nodes:
+        logp += family_logprob(net, node, expanded)
+    return expanded, logp.reshape((states.shape[0], assignments.shape[0]))
+    
+def logsumexp(a, axis=None):
+    """log(sum(exp(a))) along axis without overflow"""
+    top = N.max(a, axis=axis, keepdims=True)
+    top[~N.isfinite(top)] = 0.
+    out = N.log(N.sum(N.exp(a - top), axis=axis, keepdims=True)) + top
+    return out.squeeze(axis=axis) if axis is not None else out.item()
+
+def cpt(net, data, nodes=None, bias=0.0, sparse=False, prior=None, alpha=1.0, log=False, weights=None):
     """
     Calculate conditional probability tables.  This function
     modifies the bayesian network.
@@ -8,6 +580,18 @@ def cpt(net, data, nodes=None, bias=0.0):
     PARAMETERS:
         net     A Bayesian network
         data    A dataset
+        nodes   nodes to calculate (default is all nodes)
+        sparse  store counts of observed configurations only (SparseCPT)
+                instead of dense numer/denom tables.  Nodes that already
+                have a sparse table keep using it.
+        prior   pseudo-counts used for the log probability tables:
+                None (no smoothing), 'laplace' or 'bdeu'
+        alpha   pseudo-count per cell ('laplace') or equivalent
+                sample size ('bdeu')
+        log     build the log probability tables (see logcpt) now
+                instead of on first use
+        weights number of times each row of data is counted, e.g. the
+                multiplicities of util.compress
 
     RETURN:
         None
@@ -23,43 +607,222 @@ def cpt(net, data, nodes=None, bias=0.0):
     elif bias < 0.0:
         bias = 0.0
     
-    tiny = N.finfo(float).tiny
     predd = net.pred
     nlut = net.graph['nilut']
     nsum = N.sum
     data = N.atleast_2d(data)
-    for n, d in nodedict.iteritems():
-        #we need to check if cptdim already exists.
-        in_edges = d.get('cptdim', predd[n].keys().append(n))
-        numer = d.get('numer', N.zeros([net.node[x]['nstates'] for x in in_edges], dtype=int))
-        denom = d.get('denom', N.zeros(numer.shape, dtype=int))
-        #cpt = d.get('cpt', N.zeros(numer.shape, dtype=float))
-        #print "Denom shape: ",denom.shape
-        #numer = N.zeros([net.node[x]['nstates'] for x in in_edges])
-        #denom = N.zeros(len(in_edges))
-        #print "Calculating cpt for node: {0} (inedges: {1})".format(n, in_edges)
-        in_edges_id = [nlut[x] for x in in_edges]
-        for state in N.ndindex(numer.shape):
-            matches = data[:,in_edges_id] == state
-            z = nsum(matches.all(axis=1))
-            y = nsum(matches[:,:-1].all(axis=1))
-            #print "z:{0}\ty:{1}".format(z,y)
-            #print state
-            numer[state] += z
-            denom[state] += y
-            #cpt[state] = tiny if z == 0 or y == 0 else float(z)/y
-        
-        #try:
-            #old = d['cpt']
-            #tmp = N.absolute(old - cpt) * bias
-            #cpt = N.where(old < cpt, cpt - tmp, cpt + tmp)
-        #except KeyError:
-            ##cpt table does not exist
-            #pass
-        
-        #d['cpt'] = cpt
-        d['numer'] = numer
-        d['denom'] = denom
-        d['cptdim'] = tuple(in_edges)
-
-            
\ No newline at end of file
+    if weights is not None:
+        weights = N.asarray(weights)
+    instrument.count('cpt.rows', data.shape[0])
+    count_dtype = N.uint32 if COMPACT and data.shape[0] < 2**32 else int
+    with instrument.timer('cpt'):
+        for n, d in nodedict.iteritems():
+            #we need to check if cptdim already exists.
+            in_edges = d.get('cptdim', predd[n].keys() + [n])
+            in_edges_id = [nlut[x] for x in in_edges]
+            
+            #only rows where the whole family is observed are counted
+            states = as_states(data[:,in_edges_id])
+            w = weights
+            complete = (states != MISSING).all(axis=1)
+            if not complete.all():
+                states = states[complete]
+                if w is not None:
+                    w = w[complete]
+        
+            if sparse or 'sparse' in d:
+                table = d.get('sparse', None)
+                if table is None:
+                    table = SparseCPT([net.node[x]['nstates'] for x in in_edges])
+                table.update(states, w)
+                d['sparse'] = table
+                instrument.count('cpt.cells', table.keys.size)
+            else:
+                numer = d.get('numer', N.zeros([net.node[x]['nstates'] for x in in_edges], dtype=count_dtype))
+                denom = d.get('denom', N.zeros(numer.shape, dtype=numer.dtype))
+                #uint32 counts switch to int64 before they could overflow
+                added = states.shape[0] if w is None else w.sum()
+                if numer.dtype == N.uint32 and (denom.max() if denom.size else 0) + added >= 2**32:
+                    numer, denom = numer.astype(N.int64), denom.astype(N.int64)
+                #cpt = d.get('cpt', N.zeros(numer.shape, dtype=float))
+                #print "Denom shape: ",denom.shape
+                #numer = N.zeros([net.node[x]['nstates'] for x in in_edges])
+                #denom = N.zeros(len(in_edges))
+                #print "Calculating cpt for node: {0} (inedges: {1})".format(n, in_edges)
+                for state in N.ndindex(numer.shape):
+                    matches = states == state
+                    if w is None:
+                        z = nsum(matches.all(axis=1))
+                        y = nsum(matches[:,:-1].all(axis=1))
+                    else:
+                        z = nsum(w[matches.all(axis=1)])
+                        y = nsum(w[matches[:,:-1].all(axis=1)])
+                    #print "z:{0}\ty:{1}".format(z,y)
+                    #print state
+                    numer[state] += z
+                    denom[state] += y
+                    #cpt[state] = tiny if z == 0 or y == 0 else float(z)/y
+            
+                #try:
+                    #old = d['cpt']
+                    #tmp = N.absolute(old - cpt) * bias
+                    #cpt = N.where(old < cpt, cpt - tmp, cpt + tmp)
+                #except KeyError:
+                    ##cpt table does not exist
+                    #pass
+            
+                #d['cpt'] = cpt
+                d['numer'] = numer
+                d['denom'] = denom
+                instrument.count('cpt.cells', numer.size)
+            d['cptdim'] = tuple(in_edges)
+        
+            #counts changed, cached tables derived from them are stale
+            d['version'] = d.get('version', 0) + 1
+            d['prior'] = (prior, alpha)
+            if log:
+                logcpt(net, n)
+
+################################################################################
+#Count shards
+#A shard holds the counts of each family of a network over one partition of
+#the data: {node: {'cptdim': (...), 'numer': ..., 'denom': ...}} or, for
+#sparse tables, {node: {'cptdim': (...), 'sparse': SparseCPT}}.  Shards of
+#the same network are summed with merge_shards and fitted with apply_shard.
+################################################################################
+_COUNTS = ('numer', 'denom', 'sparse')
+
+def shard(net, data, nodes=None, sparse=False, weights=None):
+    """Count data into a shard without touching net
+    
+    PARAMETERS:
+        net         A Bayesian network (its edges and nstates are used)
+        data        one partition of the dataset
+        nodes       nodes to count (default is all nodes)
+        sparse      count into SparseCPT tables
+        weights     multiplicity of each row of data
+        
+    RETURNS:
+        dict        shard of the counts of each node
+    """
+    work = net.copy()
+    for node, d in work.node.iteritems():
+        for key in _COUNTS:
+            d.pop(key, None)
+        #parents in a fixed order, so shards counted elsewhere line up
+        if 'cptdim' not in d:
+            d['cptdim'] = tuple(sorted(work.pred[node], key=str)) + (node,)
+    cpt(work, data, nodes, sparse=sparse, weights=weights)
+    return counts(work, nodes)
+    
+def counts(net, nodes=None):
+    """Shard of the counts already on the nodes of net"""
+    result = {}
+    for node, d in net.node.iteritems():
+        if nodes is not None and node not in nodes:
+            continue
+        entry = {'cptdim': tuple(d['cptdim'])}
+        if 'sparse' in d:
+            entry['sparse'] = d['sparse']
+        elif 'numer' in d and 'denom' in d:
+            entry['numer'] = d['numer']
+            entry['denom'] = d['denom']
+        else:
+            continue
+        result[node] = entry
+    return result
+    
+def merge_shards(shards):
+    """Sum shards of the same network into one shard
+    
+    PARAMETERS:
+        shards      iterable of shards
+        
+    RETURNS:
+        dict        merged shard (the inputs are left unchanged)
+    """
+    merged = {}
+    for part in shards:
+        for node, entry in part.iteritems():
+            total = merged.get(node, None)
+            if total is None:
+                total = {'cptdim': entry['cptdim']}
+                if 'sparse' in entry:
+                    total['sparse'] = SparseCPT(entry['sparse'].shape)
+                else:
+                    total['numer'] = N.zeros(entry['numer'].shape, dtype=entry['numer'].dtype)
+                    total['denom'] = N.zeros(entry['denom'].shape, dtype=entry['denom'].dtype)
+                merged[node] = total
+            if entry['cptdim'] != total['cptdim'] or ('sparse' in entry) != ('sparse' in total):
+                raise ValueError("Shards of node {0} have different families or formats".format(node))
+            if 'sparse' in entry:
+                total['sparse'].merge(entry['sparse'])
+            else:
+                if entry['numer'].shape != total['numer'].shape:
+                    raise ValueError("Shards of node {0} have different shapes".format(node))
+                total['numer'] = total['numer'] + entry['numer']
+                total['denom'] = total['denom'] + entry['denom']
+    return merged
+    
+def apply_shard(net, part, prior=None, alpha=1.0):
+    """Replace the counts of the nodes of net with those of a shard
+    
+    PARAMETERS:
+        net         A Bayesian network
+        part        shard (see merge_shards)
+        prior       pseudo-counts of the log probability tables (see cpt)
+        alpha       pseudo-count per cell or equivalent sample size
+        
+    RETURNS:
+        None
+    """
+    for node, entry in part.iteritems():
+        d = net.node[node]
+        for key in _COUNTS + ('cpt',):
+            d.pop(key, None)
+        d.update((k, v) for k, v in entry.iteritems())
+        d['cptdim'] = tuple(entry['cptdim'])
+        d['version'] = d.get('version', 0) + 1
+        d['prior'] = (prior, alpha)
+        
+def save_shard(part, net, filename):
+    """Write a shard to a numpy .npz file
+    
+    Nodes are stored by their id in the lookup table of net, so the shard
+    can be loaded against any copy of the network.
+    """
+    nilut = net.graph['nilut']
+    arrays = {}
+    for node, entry in part.iteritems():
+        prefix = "{0}.".format(nilut[node])
+        arrays[prefix + 'cptdim'] = N.array([nilut[x] for x in entry['cptdim']], dtype=int)
+        if 'sparse' in entry:
+            table = entry['sparse']
+            arrays[prefix + 'shape'] = N.array(table.shape, dtype=int)
+            for key in ('keys', 'counts', 'pkeys', 'pcounts'):
+                arrays[prefix + key] = getattr(table, key)
+        else:
+            arrays[prefix + 'numer'] = entry['numer']
+            arrays[prefix + 'denom'] = entry['denom']
+    with open(filename, 'wb') as f:
+        N.savez(f, **arrays)
+        
+def load_shard(filename, net):
+    """Read a shard written by save_shard"""
+    inlut = net.graph['inlut']
+    result = {}
+    with N.load(filename) as f:
+        ids = set(int(key.split('.', 1)[0]) for key in f.files)
+        for i in ids:
+            prefix = "{0}.".format(i)
+            entry = {'cptdim': tuple(inlut[x] for x in f[prefix + 'cptdim'])}
+            if prefix + 'shape' in f.files:
+                table = SparseCPT(f[prefix + 'shape'])
+                for key in ('keys', 'counts', 'pkeys', 'pcounts'):
+                    setattr(table, key, f[prefix + key])
+                entry['sparse'] = table
+            else:
+                entry['numer'] = f[prefix + 'numer']
+                entry['denom'] = f[prefix + 'denom']
+            result[inlut[i]] = entry
+    return result
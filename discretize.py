@@ -0,0 +1,202 @@
+"""
+Discretization of continuous columns into a small number of states.
+
+Bin edges are computed in one pass over the values (chunks of a column can be
+fed one at a time) and stored on the node as 'edges', so new data is binned
+identically with numpy.searchsorted (see apply).
+
+Methods:
+    width       equal-width bins between the minimum and the maximum
+    quantile    equal-frequency bins from an approximate quantile sketch
+    mdl         supervised entropy splits (Fayyad & Irani) with the MDL
+                stopping rule; needs the states of a target variable
+"""
+
+import numpy as N
+import cpt
+
+METHODS = ('width', 'quantile', 'mdl')
+
+class QuantileSketch(object):
+    """Approximate quantiles of a stream of values in bounded memory
+
+    The sketch keeps at most 2*size weighted points.  When full, the points
+    are sorted and merged into size points of equal weight, so the rank error
+    stays around 1/size of the number of values seen.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.values = N.zeros(0)
+        self.weights = N.zeros(0)
+
+    def update(self, values):
+        """Add a chunk of values (nan are ignored)"""
+        values = N.asarray(values, dtype=float).ravel()
+        values = values[~N.isnan(values)]
+        self.values = N.concatenate((self.values, values))
+        self.weights = N.concatenate((self.weights, N.ones(values.size)))
+        if self.values.size > 2*self.size:
+            self._compress()
+
+    def merge(self, other):
+        """Add the points of another sketch"""
+        self.values = N.concatenate((self.values, other.values))
+        self.weights = N.concatenate((self.weights, other.weights))
+        if self.values.size > 2*self.size:
+            self._compress()
+
+    def _compress(self):
+        order = N.argsort(self.values, kind='mergesort')
+        values, weights = self.values[order], self.weights[order]
+        cum = N.cumsum(weights)
+        #bucket of each point by cumulative weight
+        bucket = N.minimum((cum - weights) * self.size // cum[-1], self.size - 1).astype(int)
+        total = N.bincount(bucket, weights=weights, minlength=self.size)
+        mean = N.bincount(bucket, weights=weights*values, minlength=self.size)
+        keep = total > 0
+        self.values = mean[keep] / total[keep]
+        self.weights = total[keep]
+
+    def quantiles(self, qs):
+        """Approximate values at the quantiles qs (in [0, 1])"""
+        if self.values.size == 0:
+            return N.zeros(len(qs))
+        order = N.argsort(self.values, kind='mergesort')
+        values, weights = self.values[order], self.weights[order]
+        cum = (N.cumsum(weights) - weights / 2.0) / weights.sum()
+        return N.interp(qs, cum, values)
+
+def width_edges(chunks, bins):
+    """Interior edges of bins equal-width bins
+
+    PARAMETERS:
+        chunks      iterable of arrays of values
+        bins        number of bins
+
+    RETURNS:
+        ndarray     bins-1 increasing edges
+    """
+    lo, hi = N.inf, -N.inf
+    for chunk in chunks:
+        chunk = N.asarray(chunk, dtype=float)
+        chunk = chunk[~N.isnan(chunk)]
+        if chunk.size:
+            lo, hi = min(lo, chunk.min()), max(hi, chunk.max())
+    if lo > hi:
+        return N.zeros(0)
+    return N.unique(N.linspace(lo, hi, bins + 1)[1:-1])
+
+def quantile_edges(chunks, bins, size=1000):
+    """Interior edges of bins (approximately) equal-frequency bins"""
+    sketch = QuantileSketch(size)
+    for chunk in chunks:
+        sketch.update(chunk)
+    return N.unique(sketch.quantiles(N.arange(1, bins) / float(bins)))
+
+def _entropy(counts):
+    """Entropy (nats) of each row of class counts"""
+    counts = N.atleast_2d(counts).astype(float)
+    total = counts.sum(axis=1)
+    p = counts / N.maximum(total, 1)[:,None]
+    terms = N.zeros(p.shape)
+    terms[p > 0] = p[p > 0] * N.log(p[p > 0])
+    return -terms.sum(axis=1)
+
+def _mdl_split(values, labels, nclasses, edges):
+    """Recursively add the accepted MDL cut points of sorted values to edges"""
+    n = values.size
+    if n < 2:
+        return
+    #class counts left of each candidate cut (between distinct values)
+    onehot = N.zeros((n, nclasses))
+    onehot[N.arange(n), labels] = 1
+    left = N.cumsum(onehot, axis=0)[:-1]
+    cuts = N.flatnonzero(values[1:] != values[:-1])
+    if cuts.size == 0:
+        return
+    left = left[cuts]
+    right = onehot.sum(axis=0) - left
+    nleft = cuts + 1.0
+    ent = _entropy(onehot.sum(axis=0))[0]
+    ents = (nleft * _entropy(left) + (n - nleft) * _entropy(right)) / n
+    best = N.argmin(ents)
+    gain = ent - ents[best]
+
+    #MDL stopping rule of Fayyad & Irani
+    k = N.count_nonzero(onehot.sum(axis=0))
+    k1 = N.count_nonzero(left[best])
+    k2 = N.count_nonzero(right[best])
+    delta = N.log(3**k - 2) - (k*ent - k1*_entropy(left[best])[0] - k2*_entropy(right[best])[0])
+    if gain <= (N.log(n - 1) + delta) / n:
+        return
+
+    cut = cuts[best]
+    edges.append((values[cut] + values[cut+1]) / 2.0)
+    _mdl_split(values[:cut+1], labels[:cut+1], nclasses, edges)
+    _mdl_split(values[cut+1:], labels[cut+1:], nclasses, edges)
+
+def mdl_edges(values, labels):
+    """Supervised edges by recursive minimum entropy splits (MDL stopping)
+
+    PARAMETERS:
+        values      continuous values
+        labels      state index of the target variable for each value
+
+    RETURNS:
+        ndarray     increasing edges (possibly empty)
+    """
+    values = N.asarray(values, dtype=float)
+    labels = N.asarray(labels).astype(int)
+    keep = ~N.isnan(values) & (labels != cpt.MISSING)
+    values, labels = values[keep], labels[keep]
+    order = N.argsort(values, kind='mergesort')
+    edges = []
+    _mdl_split(values[order], labels[order], labels.max() + 1 if labels.size else 1, edges)
+    return N.array(sorted(edges))
+
+def fit_edges(chunks, method='quantile', bins=5, labels=None):
+    """Bin edges of a column with the given method
+
+    PARAMETERS:
+        chunks      array of values or an iterable of chunks of values
+        method      'width', 'quantile' or 'mdl'
+        bins        number of bins ('width' and 'quantile')
+        labels      target states of each value ('mdl' only)
+
+    RETURNS:
+        ndarray     increasing edges
+    """
+    if isinstance(chunks, N.ndarray):
+        chunks = [chunks]
+    if method == 'width':
+        return width_edges(chunks, bins)
+    elif method == 'quantile':
+        return quantile_edges(chunks, bins)
+    elif method == 'mdl':
+        if labels is None:
+            raise ValueError("mdl discretization needs target labels")
+        return mdl_edges(N.concatenate([N.asarray(c, dtype=float) for c in chunks]), labels)
+    else:
+        raise ValueError("Unknown discretization: {0}".format(method))
+
+def apply(values, edges):
+    """State index of each value (nan become cpt.MISSING)"""
+    values = N.asarray(values, dtype=float)
+    states = N.searchsorted(edges, values, side='right').astype(float)
+    states[N.isnan(values)] = cpt.MISSING
+    return states
+
+def state_names(edges):
+    """Names of the bins delimited by edges"""
+    bounds = ['-inf'] + ['{0:g}'.format(e) for e in edges] + ['inf']
+    return ['[{0}, {1})'.format(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+def set_states(net, node, edges):
+    """Store edges on node and make its states the bins they delimit"""
+    d = net.node[node]
+    d['edges'] = N.asarray(edges, dtype=float)
+    names = state_names(edges)
+    d['nstates'] = len(names)
+    d['ind_states'] = {i:name for i, name in enumerate(names)}
+    d['states_ind'] = {name:i for i, name in enumerate(names)}
@@ -0,0 +1,61 @@
+"""
+Drawing, Graphviz layout and dot export of networks.
+
+Kept apart from network.py so that loading and scoring networks never imports
+pydot or matplotlib.  The Network methods and the network.drawnet/pydotnet
+functions import this module on first use.
+"""
+
+import networkx as nx
+import pydot
+import matplotlib.pyplot as plt
+import instrument
+
+def layout(net, prog="dot", args=''):
+    """Node positions computed by a Graphviz program"""
+    return nx.graphviz_layout(net, prog=prog, args=args)
+
+def as_dotfile(net, filename):
+    """Saves network as a dot file."""
+    nx.write_dot(net, filename)
+
+def as_pydot(net):
+    """Returns a pydot instance for the network."""
+    return nx.to_pydot(net)
+
+def drawnet(g):
+    nx.draw_graphviz(g)
+    plt.show()
+    
+def pydotnet(control, cand, colorsame='black', controldiff='purple', canddiff='red'):
+    """nets is a sequence of network objects.  The edges of the first are taken to be
+    the universal set
+    
+    colorsame = color common edges
+    color diffenrent = color unique edges
+    """
+    
+    pdnet = pydot.Dot(graph_type='digraph')
+    
+    #add the nodes to the Graph
+    nodes = control.nodes()
+    [pdnet.add_node(n) for n in map(pydot.Node, nodes)]
+    
+    edges = [set(n.edges()) for n in (control, cand)]
+    
+    #intersection give edges in both networks
+    sameedges = set.intersection(*edges)
+    #get the unique edges in each network
+    controluniqedges = set(control.edges())-sameedges
+    canduniqedges = set(cand.edges())-sameedges
+    
+    samecol = lambda e: pydot.Edge(*e, color=colorsame)
+    diffcol = lambda e: pydot.Edge(*e, color=controldiff, style='dashed')
+    uniquecol = lambda e: pydot.Edge(*e, color=canddiff)
+    [pdnet.add_edge(e) for e in map(samecol, sameedges)]
+    [pdnet.add_edge(e) for e in map(diffcol, controluniqedges)]
+    [pdnet.add_edge(e) for e in map(uniquecol, canduniqedges)]
+    instrument.progress('pydotnet', same=len(sameedges), control=len(controluniqedges),
+                        cand=len(canduniqedges))
+    return pdnet
+    
\ No newline at end of file
@@ -5,6 +5,9 @@ described in DSC format.  An optional dataset may be loaded as well
 
 import numpy as np
 import network
+import reader
+import cpt
+import instrument
 
 class DSC_Parser(object):
         def __init__(self, filename, dataname=None):
@@ -37,8 +40,9 @@ class DSC_Parser(object):
                 """
 
                 self.name = self._data[0].split()[-1]
-                self._getNodes()
-                self._getCPT()
+                with instrument.timer('load.dsc'):
+                        self._getNodes()
+                        self._getCPT()
 
         def _loadData(self, dataname):
                 """Load an optional dataset along with dsc file
@@ -50,15 +54,18 @@ class DSC_Parser(object):
                     dataset     dataset in a numpy array
                 """
                 
-                data = np.recfromcsv(dataname, delimiter=",", names=True, autostrip=True, case_sensitive=True)
+                with instrument.timer('load'):
+                        data = np.recfromcsv(dataname, delimiter=",", names=True, autostrip=True, case_sensitive=True, usemask=True)
+                instrument.count('load.rows', data.size)
                 net = self.network
                 m, n = data.size, len(data.dtype.names)
                 dataset = np.zeros((m, n), order='F')
                 for node, d in net.node.iteritems():
-                        dstates = d['states_ind']
                         col = net.graph['nilut'][node]
-                        dataset[:,col] = [dstates[str(s)] for s in data[node]]
+                        dataset[:,col] = reader.encode(data[node], d['states_ind'])
                         
+                if cpt.COMPACT:
+                        dataset = cpt.compact_states(dataset, max(d['nstates'] for d in net.node.itervalues()))
                 return dataset
                 
         def _getNodes(self):
@@ -0,0 +1,155 @@
+"""
+Expectation maximization of the CPT tables from incomplete data.
+
+Missing values are encoded as cpt.MISSING.  Rows are grouped by their pattern
+of missing values (see cpt.missing_patterns).  The observed families of a
+group are counted once, and every E-step sums out each component of its
+relevant missing cells on its own, scoring only the families holding them,
+and accumulates their expected counts with weighted bincounts.
+
+Barren missing nodes (all children barren, see cpt.marginal_plan) get no
+expected counts from the rows that miss them.  Those counts would only be
+proportional to the current table, so the fixed point of EM is the same.
+Components with too many completions are left out of the rows that miss
+them, as incomplete families are left out of cpt.cpt counts, and reported.
+"""
+
+import numpy as N
+import cpt
+import instrument
+
+def _family_counts(states, shape, weights=None):
+    """(Weighted) dense counts of the family states (m, k array)"""
+    keys = N.ravel_multi_index(tuple(states.astype(int).T), shape)
+    return N.bincount(keys, weights=weights, minlength=int(N.prod(shape))).reshape(shape)
+
+def _expected_counts(net, data, rows, members, nodes, total, families, counts, blocksize):
+    """Add the expected counts of the families of nodes over the completions
+    of the missing columns members of rows (see cpt.marginal_plan)
+    
+    RETURNS:
+        loglik      log probability of the families summed over the rows
+    """
+    chunk = min(total, blocksize)
+    step = max(1, blocksize // chunk)
+    chunks = [(first, first + chunk) for first in xrange(0, total, chunk)]
+    single = cpt.completions(net, members) if len(chunks) == 1 else None
+    loglik = 0.
+    for start in xrange(0, rows.size, step):
+        block = rows[start:start+step]
+        norm = None
+        if single is None:
+            #chunked completions need the norm before the weights
+            norm = N.empty(block.size)
+            norm.fill(-N.inf)
+            for first, stop in chunks:
+                assignments = cpt.completions(net, members, first, stop)
+                logp = cpt.completion_logprob(net, nodes, data[block], members, assignments)[1]
+                norm = N.logaddexp(norm, cpt.logsumexp(logp, axis=1))
+        for first, stop in chunks:
+            assignments = single if single is not None else cpt.completions(net, members, first, stop)
+            expanded, logp = cpt.completion_logprob(net, nodes, data[block], members, assignments)
+            if norm is None:
+                norm = cpt.logsumexp(logp, axis=1)
+            #posterior weight of each completion of each row
+            weights = N.exp(logp - norm[:,None]).ravel()
+            for node in nodes:
+                ids, shape = families[node]
+                counts[node] += _family_counts(expanded[:,ids], shape, weights)
+        loglik += norm.sum()
+    return loglik
+    
+def em(net, data, maxiters=50, tol=1e-6, prior='laplace', alpha=1.0, blocksize=2**20,
+       maxcompletions=cpt.MAX_COMPLETIONS):
+    """Fit the CPT tables of net from data with missing values
+    
+    The tables start from the counts of the complete families (see cpt.cpt).
+    Each iteration replaces them by the counts expected under the current
+    tables (E-step) and refreshes the log probability tables from those
+    (M-step).  The counts are stored as dense float numer/denom tables.
+    
+    PARAMETERS:
+        net         A Bayesian network (its nodes need nstates)
+        data        A dataset with missing values encoded as cpt.MISSING
+        maxiters    maximum number of iterations
+        tol         stop once the log likelihood improves by less than
+                    tol (relative)
+        prior       pseudo-counts of the tables ('laplace', 'bdeu' or None).
+                    Without pseudo-counts, unseen configurations get a
+                    zero probability and are never completed.
+        alpha       pseudo-count per cell ('laplace') or equivalent
+                    sample size ('bdeu')
+        blocksize   maximum number of completed rows scored at once
+        maxcompletions  largest number of completions of a component of
+                    missing cells, the families of larger ones are left out
+        
+    RETURNS:
+        loglik      log likelihood of the observed data in the last E-step
+    """
+    data = cpt.as_states(N.atleast_2d(data))
+    nlut = net.graph['nilut']
+    families = {}
+    for node, d in net.node.iteritems():
+        cptdim = tuple(d.get('cptdim', net.pred[node].keys() + [node]))
+        families[node] = ([nlut[x] for x in cptdim], [net.node[x]['nstates'] for x in cptdim])
+        d['cptdim'] = cptdim
+        d.pop('sparse', None)
+    
+    groups = cpt.missing_patterns(data)
+    complete = N.concatenate([rows for cols, rows in groups if not cols] or [N.zeros(0, dtype=int)])
+    
+    #counts of the complete rows never change
+    base = {}
+    for node, (ids, shape) in families.iteritems():
+        base[node] = _family_counts(data[complete][:,ids], shape).astype(float)
+    
+    #neither do the counts of the observed families of the other rows
+    plans = []
+    for cols, rows in groups:
+        if not cols:
+            continue
+        fixed, components, dropped = cpt.marginal_plan(net, cols, maxcompletions)
+        for node in fixed:
+            ids, shape = families[node]
+            base[node] += _family_counts(data[rows][:,ids], shape)
+        for members, nodes, total in dropped:
+            instrument.progress('em.dropped_families', rows=rows.size, columns=members,
+                                completions=total, families=len(nodes))
+        plans.append((rows, fixed, components))
+    
+    def mstep(counts):
+        for node, numer in counts.iteritems():
+            d = net.node[node]
+            d['numer'] = numer
+            d['denom'] = N.repeat(numer.sum(axis=-1)[...,None], numer.shape[-1], axis=-1)
+            d['prior'] = (prior, alpha)
+            d['version'] = d.get('version', 0) + 1
+    
+    #start from the complete families, as cpt.cpt would count them
+    initial = {}
+    for node, (ids, shape) in families.iteritems():
+        states = data[:,ids]
+        initial[node] = _family_counts(states[(states != cpt.MISSING).all(axis=1)], shape).astype(float)
+    mstep(initial)
+    
+    previous = -N.inf
+    for iteration in xrange(maxiters):
+        with instrument.timer('em.estep'):
+            counts = {node: c.copy() for node, c in base.iteritems()}
+            loglik = net.logprob(data[complete]).sum()
+            for rows, fixed, components in plans:
+                for node in fixed:
+                    loglik += cpt.family_logprob(net, node, data[rows]).sum()
+                for members, nodes, total in components:
+                    loglik += _expected_counts(net, data, rows, members, nodes, total,
+                                               families, counts, blocksize)
+        
+        with instrument.timer('em.mstep'):
+            mstep(counts)
+        instrument.progress('em.iteration', iteration=iteration, loglik=loglik)
+        
+        if abs(loglik - previous) <= tol * abs(loglik):
+            break
+        previous = loglik
+        
+    return loglik
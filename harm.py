@@ -1,13 +1,111 @@
 #Harmony search, Python
+import os
+import random
 import numpy as N
 from random import choice
 import score
 import cpt
+import util
 import network
 import itertools
+import instrument
 
+def save_checkpoint(filename, net, hm, remaining, info, cache=None):
+    """Write the state of a harmony search to a compressed .npz file
+    
+    The file is replaced atomically, so a crash while writing leaves the
+    previous checkpoint intact.
+    
+    PARAMETERS:
+        filename    checkpoint file
+        net         network providing the lookup table
+        hm          harmony memory (list of scored Networks)
+        remaining   iterations left
+        info        dict describing the scores (method, ess, rows); the
+                    scores are only reused by a search with the same info
+        cache       family scores (FamilyScorer.cache) to save as well
+        
+    RETURNS:
+        None
+    """
+    nilut = net.graph['nilut']
+    n = len(nilut)
+    adj = N.zeros((len(hm), n*n), dtype=bool)
+    for k, h in enumerate(hm):
+        for u, v in h.edges():
+            adj[k, nilut[u]*n + nilut[v]] = True
+    arrays = {'memory': N.packbits(adj, axis=1),
+              'scores': N.array([h.score for h in hm], dtype=float),
+              'remaining': N.array(remaining),
+              'nnodes': N.array(n),
+              'info': N.array([info['method'], repr(float(info['ess'])), str(info['rows'])])}
+    
+    version, pystate, gauss = random.getstate()
+    arrays['py_state'] = N.array(pystate, dtype=N.int64)
+    arrays['py_extra'] = N.array([version, N.nan if gauss is None else gauss])
+    kind, keys, pos, has_gauss, cached = N.random.get_state()
+    arrays['np_keys'] = keys
+    arrays['np_extra'] = N.array([pos, has_gauss, cached])
+    
+    if cache:
+        families = cache.items()
+        arrays['fam_nodes'] = N.array([nilut[node] for (node, parents), value in families], dtype=int)
+        arrays['fam_sizes'] = N.array([len(parents) for (node, parents), value in families], dtype=int)
+        arrays['fam_parents'] = N.array([nilut[p] for (node, parents), value in families for p in parents], dtype=int)
+        arrays['fam_scores'] = N.array([value for key, value in families], dtype=float)
+    
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        N.savez_compressed(f, **arrays)
+    os.rename(tmp, filename)
+    
+def _share_graph(h, net):
+    """Copy the graph attributes of net (search constraints, ...) onto the
+    harmony h but keep h's lookup tables, its ancestor and descendant
+    bitsets are indexed by them"""
+    h.graph.update((k, v) for k, v in net.graph.iteritems() if k not in ('inlut', 'nilut'))
+    
+def load_checkpoint(filename, net):
+    """Read a checkpoint written by save_checkpoint
+    
+    RETURNS:
+        dict        'memory' (Networks with their scores), 'remaining',
+                    'info', 'py_state' and 'np_state' (random generator
+                    states) and 'families' (family score cache, may be empty)
+    """
+    inlut = net.graph['inlut']
+    with N.load(filename) as f:
+        n = int(f['nnodes'])
+        if n != len(inlut):
+            raise ValueError("Checkpoint {0} has {1} nodes, the network {2}".format(filename, n, len(inlut)))
+        nodes = [inlut[i] for i in xrange(n)]
+        adj = N.unpackbits(f['memory'], axis=1)[:,:n*n].reshape((-1, n, n)).astype(bool)
+        memory = []
+        for matrix, value in zip(adj, f['scores']):
+            h = network.Network(nodes, [(inlut[u], inlut[v]) for u, v in zip(*N.nonzero(matrix))])
+            _share_graph(h, net)
+            h.score = float(value)
+            memory.append(h)
+        method, ess, rows = f['info']
+        state = {'memory': memory,
+                 'remaining': int(f['remaining']),
+                 'info': {'method': str(method), 'ess': float(ess), 'rows': int(rows)}}
+        
+        version, gauss = f['py_extra']
+        state['py_state'] = (int(version), tuple(int(x) for x in f['py_state']), None if N.isnan(gauss) else float(gauss))
+        pos, has_gauss, cached = f['np_extra']
+        state['np_state'] = ('MT19937', f['np_keys'], int(pos), int(has_gauss), float(cached))
+        
+        families = {}
+        if 'fam_nodes' in f.files:
+            parents = N.split(f['fam_parents'], N.cumsum(f['fam_sizes'])[:-1])
+            for node, ids, value in zip(f['fam_nodes'], parents, f['fam_scores']):
+                families[inlut[int(node)], tuple(sorted(inlut[int(p)] for p in ids))] = float(value)
+        state['families'] = families
+    return state
+    
 class HarmonySearch(object):
-    def __init__(self, net, hms=30, targetQuality=-N.inf, maxiters=500, hmcr=.95, par=.2, **kargs):
+    def __init__(self, net, hms=30, targetQuality=N.inf, maxiters=500, hmcr=.95, par=.2, method='loglik', ess=1.0, processes=None, racing=False, **kargs):
         """Harmony Search
         
         net: initial starting network.  If a number, a network of n nodes will
@@ -19,6 +117,13 @@ class HarmonySearch(object):
             be considered when generating new solutions
         par: pitch adjustment rate.  Rate at which notes from memory will be
             adjusted when generating new solutions
+        method: network score, one of score.SCORES ('loglik', 'bic', 'aic',
+            'bdeu', 'k2')
+        ess: equivalent sample size of the 'bdeu' score
+        processes: number of worker processes scoring the initial memory
+        racing: reject weak harmonies on row subsamples first (see
+            score.RacingScorer).  Either way a harmony stops being scored
+            once it falls below the worst harmony in memory.
         """
         if isinstance(net, int):
             self.net = network.Network(xrange(net))
@@ -37,6 +142,10 @@ class HarmonySearch(object):
         self.hms = hms
         self.par = par
         self.hmcr = hmcr
+        self.method = method
+        self.ess = ess
+        self.processes = processes
+        self.racing = racing
         
         #initial quality.
         self.targetQuality = targetQuality
@@ -44,7 +153,9 @@ class HarmonySearch(object):
     def _gen_random_harmony(self, nodes):
         net = network.random_network(nodes,
                                     required_edges=self.white_edges,
-                                    prohibited_edges=self.black_edges)
+                                    prohibited_edges=self.black_edges,
+                                    max_parents=self.net.graph.get('max_parents', None),
+                                    candidates=self.net.graph.get('candidate_parents', None))
         return net
         
     def _gen_random_instrument(self, indices=True):
@@ -65,13 +176,35 @@ class HarmonySearch(object):
         else:
             return ()
         
-    def search(self, data, every=10, amnesia=50):
-        """Harmony search in Python"""
+    def search(self, data, every=10, amnesia=50, weights=None, checkpoint=None, checkpoint_every=100,
+               resume=None, warm_start=None, save_families=True):
+        """Harmony search in Python
+        
+        weights: multiplicity of each row of data, to search over the
+            distinct rows of util.compress
+        checkpoint: file the search state is saved to every checkpoint_every
+            iterations and at the end (see save_checkpoint)
+        resume: checkpoint file to continue from.  Memory, iteration counter,
+            random generator states and family scores are restored.
+        warm_start: checkpoint file or list of Networks seeding the memory
+            (filled up with random networks).  Scores from a checkpoint of a
+            search with the same score and data are reused.
+        save_families: include the cached family scores in checkpoints
+        """
         #harmony memory
         
         #cache network nodes and common functions
         nodes = self.net.nodes()
         Nshuf = N.random.shuffle
+        
+        #search space constraints (see Network.edge_allowed)
+        max_parents = self.net.graph.get('max_parents', None)
+        candidates = self.net.graph.get('candidate_parents', None)
+        if candidates is not None:
+            pairs = set((u, v) for v, parents in candidates.iteritems() for u in parents)
+            pairs |= set((v, u) for u, v in pairs)
+        else:
+            pairs = None
         stronglyconnected = network.is_strongly_connected
         
         def newHarmony(hm, net):
@@ -83,6 +216,9 @@ class HarmonySearch(object):
                     if n1 == n2:
                         #continue on self-loops
                         continue
+                    elif pairs is not None and (n1, n2) not in pairs:
+                        #neither direction is a candidate edge
+                        continue
                     else:
                         randvals = N.random.rand(5)
                         
@@ -112,45 +248,70 @@ class HarmonySearch(object):
                                     case = (case + 1) % 4
                             
                             #apply the case
-                            if case == 1 and (n1, n2) not in self.black_edges:
+                            if case == 1 and (n1, n2) not in self.black_edges and net.edge_allowed(n1, n2):
                                 #add n1, n2 to edges
-                                #but check strong connectedness
-                                net.add_edge(n1, n2)
-                                if not net.is_acyclic():
-                                    #we are now cyclic
-                                    net.remove_edge(n1, n2)
-                            elif case == 3 and (n2, n1) not in self.black_edges:
+                                #unless it closes a cycle
+                                if not net.creates_cycle(n1, n2):
+                                    net.add_edge(n1, n2)
+                            elif case == 3 and (n2, n1) not in self.black_edges and net.edge_allowed(n2, n1):
                                 #add n2, n1 to edges
-                                net.add_edge(n2, n1)
-                                if not net.is_acyclic():
-                                    net.remove_edge(n2, n1)
+                                if not net.creates_cycle(n2, n1):
+                                    net.add_edge(n2, n1)
                         else:
                             #ignore memory and get a single random note
-                            if randvals[3] > .6666 and (n2, n1) not in self.black_edges:
+                            if randvals[3] > .6666 and (n2, n1) not in self.black_edges and net.edge_allowed(n2, n1):
                                 #case == 3
-                                net.add_edge(n2, n1)
-                                if not net.is_acyclic():
-                                    net.remove_edge(n2, n1)
-                            elif randvals[3] < .3333 and (n1, n2) not in self.black_edges:
+                                if not net.creates_cycle(n2, n1):
+                                    net.add_edge(n2, n1)
+                            elif randvals[3] < .3333 and (n1, n2) not in self.black_edges and net.edge_allowed(n1, n2):
                                 #case == 1
-                                net.add_edge(n1, n2)
-                                if not net.is_acyclic():
-                                    net.remove_edge(n1, n2)
+                                if not net.creates_cycle(n1, n2):
+                                    net.add_edge(n1, n2)
             
             return net
             
-        hm = [self._gen_random_harmony(nodes) for i in xrange(self.hms)]
+        #families are counted and scored once for the whole search
+        if self.racing:
+            scorer = score.RacingScorer(self.net, data, self.method, self.ess, weights)
+        else:
+            scorer = score.FamilyScorer(self.net, data, self.method, self.ess, weights)
+        info = {'method': self.method, 'ess': self.ess,
+                'rows': int(data.shape[0] if weights is None else N.sum(weights))}
         maxiters = self.maxiters
         
-        #score the memory
-        print "Scoring Memory ",
-        for n in hm:
-            n.graph.update(self.net.graph)
-            n.node.update(self.net.node)
-            cpt.cpt(n, data)
-            score.itlik(n, data)
-            print ".",
-        print "Done"
+        #seed the memory from a checkpoint, previous networks and random DAGs
+        hm = []
+        if resume is not None or isinstance(warm_start, str):
+            state = load_checkpoint(resume or warm_start, self.net)
+            hm = state['memory']
+            if state['info'] == info:
+                scorer.cache.update(state['families'])
+            else:
+                for h in hm:
+                    h.score = None
+            if resume is not None:
+                maxiters = state['remaining']
+                random.setstate(state['py_state'])
+                N.random.set_state(state['np_state'])
+        elif warm_start is not None:
+            for h in warm_start:
+                h = network.Network(self.net.ordering, h.edges())
+                _share_graph(h, self.net)
+                hm.append(h)
+        hm = hm[:self.hms]
+        if len(hm) < self.hms:
+            hm.extend(network.random_networks(self.net.ordering, self.hms - len(hm),
+                                              required_edges=self.white_edges,
+                                              prohibited_edges=self.black_edges,
+                                              max_parents=max_parents,
+                                              candidates=candidates))
+        
+        #score the memory, families shared by several harmonies only once
+        unscored = [n for n in hm if n.score is None]
+        for n in unscored:
+            _share_graph(n, self.net)
+        scorer.score_many(unscored, self.processes)
+        instrument.progress('harmony.memory', scored=len(unscored), size=self.hms)
         
         #find worst and best network.
         hm.sort()
@@ -165,29 +326,46 @@ class HarmonySearch(object):
             self.net.clear()
             self.net.add_edges_from(self.initial.edges())
             newHarmony(hm, self.net)
-            cpt.cpt(self.net, data)
-            score.itlik(self.net, data)
+            #only harmonies beating the worst in memory matter
+            scorer.score(self.net, worst.score)
             if self.net > worst:
                 hm[0] = self.net.copy()
                 hm.sort()
                 best, worst = hm[-1], hm[0]
             
             if maxiters % every == 0:
-                print "Iteration {0}\tScore (b/w/c): {1}, {2}, {3}".format(maxiters, best.score, worst.score, self.net.score)
+                instrument.progress('harmony.iteration', remaining=maxiters,
+                                    best=best.score, worst=worst.score, current=self.net.score)
             
             if maxiters % amnesia == 0:
                 #introduce amnesia into the system.
-                amn = self._gen_random_harmony(nodes)
-                amn.graph.update(self.initial.graph)
-                amn.node.update(self.initial.node)
-                cpt.cpt(amn, data)
-                score.itlik(amn, data)
+                amn = self._gen_random_harmony(self.net.ordering)
+                _share_graph(amn, self.initial)
+                scorer.score(amn, worst.score)
                 
                 if amn > worst:
                     hm[0] = amn.copy()
                     hm.sort()
                 best, worst = hm[-1], hm[0]
             maxiters -= 1
+            
+            if checkpoint is not None and maxiters % checkpoint_every == 0:
+                save_checkpoint(checkpoint, self.net, hm, maxiters, info,
+                                scorer.cache if save_families else None)
+        
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, self.net, hm, maxiters, info,
+                            scorer.cache if save_families else None)
+        
+        #fit the cpt tables of the best network.  best may be a copy of the
+        #start network, whose tables (and cptdim) describe other families.
+        #Nodes of int networks have no nstates, the scorer took them from data
+        util.clearCPT(best)
+        for node, d in best.node.iteritems():
+            d.update((k, v) for k, v in self.net.node[node].iteritems()
+                     if k in ('nstates', 'states_ind', 'ind_states'))
+            d.setdefault('nstates', scorer.nstates[node])
+        cpt.cpt(best, data, weights=weights)
         return best
         
         
\ No newline at end of file
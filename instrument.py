@@ -0,0 +1,146 @@
+"""
+Lightweight instrumentation of the hot paths: named timers, counters and
+progress events.
+
+Timers and counters are disabled by default.  While disabled, timer() returns
+a shared no-op context manager and count() returns immediately, so the
+instrumented code only pays a function call.  Progress events are always
+sent to the 'bnet' logger and, once enabled, to any registered callbacks.
+
+    import logging, instrument
+    logging.basicConfig(level=logging.INFO)
+    instrument.enable()
+    ...
+    print instrument.report()
+"""
+
+import time
+import logging
+
+logger = logging.getLogger('bnet')
+logger.addHandler(logging.NullHandler())
+
+_enabled = False
+_callbacks = []
+
+#name -> [calls, seconds]
+timers = {}
+#name -> count
+counters = {}
+
+class _NullTimer(object):
+    """Timer used while instrumentation is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullTimer()
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        entry = timers.setdefault(self.name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.time() - self.start
+        return False
+
+def enable(callback=None):
+    """Turn on timers and counters
+
+    PARAMETERS:
+        callback    optional function called as callback(event, fields)
+                    for every progress event
+
+    RETURNS:
+        None
+    """
+    global _enabled
+    _enabled = True
+    if callback is not None:
+        _callbacks.append(callback)
+
+def disable():
+    """Turn off timers and counters and drop the callbacks"""
+    global _enabled
+    _enabled = False
+    del _callbacks[:]
+
+def enabled():
+    return _enabled
+
+def reset():
+    """Clear all timers and counters"""
+    timers.clear()
+    counters.clear()
+
+def timer(name):
+    """Context manager timing the enclosed block under name"""
+    if _enabled:
+        return _Timer(name)
+    return _NULL
+
+def count(name, n=1):
+    """Add n to the counter name"""
+    if _enabled:
+        counters[name] = counters.get(name, 0) + n
+
+def cache(name, hit):
+    """Record a hit (or a miss) of the cache name"""
+    if _enabled:
+        key = name + ('.hits' if hit else '.misses')
+        counters[key] = counters.get(key, 0) + 1
+
+def progress(event, **fields):
+    """Report the progress of a long running operation
+
+    PARAMETERS:
+        event       name of the event (e.g. 'harmony.iteration')
+        **fields    values describing the progress
+
+    RETURNS:
+        None
+    """
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s %s", event, " ".join("{0}={1}".format(k, v) for k, v in sorted(fields.iteritems())))
+    for callback in _callbacks:
+        callback(event, fields)
+
+def report():
+    """Summary of the timers and counters
+
+    Timers with a matching '<timer>.rows' or '<timer>.cells' counter get a
+    per second rate, caches get a hit rate.
+
+    RETURNS:
+        dict        {'timers': {name: {'calls', 'seconds'}},
+                     'counters': {name: value},
+                     'rates': {name: value}}
+    """
+    rates = {}
+    for name, (calls, seconds) in timers.iteritems():
+        for unit in ('rows', 'cells'):
+            key = "{0}.{1}".format(name, unit)
+            if key in counters and seconds > 0:
+                rates["{0}_per_sec".format(key)] = counters[key] / seconds
+    for key, hits in counters.iteritems():
+        if key.endswith('.hits'):
+            name = key[:-len('.hits')]
+            total = hits + counters.get(name + '.misses', 0)
+            rates[name + '.hit_rate'] = float(hits) / total
+    for key, misses in counters.iteritems():
+        if key.endswith('.misses') and key[:-len('.misses')] + '.hits' not in counters:
+            rates[key[:-len('.misses')] + '.hit_rate'] = 0.0
+
+    return {'timers': {k: {'calls': c, 'seconds': s} for k, (c, s) in timers.iteritems()},
+            'counters': dict(counters),
+            'rates': rates}
@@ -1,7 +1,6 @@
 import numpy as N
 import network
 
-import cpt
 import score
 
 """A smart greedy learner.  Casts a net of random values far apart and chooses the net with the highest log likelihood as a starting place."""
@@ -19,42 +18,58 @@ class Greedy(Learner):
     """A simple greedy learner"""
     
     def __init__(self, nodes, data, initial=None, nsamples=0, **kargs):
-        super(Greedy, self).__init__(data, intial)
+        super(Greedy, self).__init__(data, initial)
         self.nsamples = nsamples
         self.__dict__.update(kargs)
-        self.stats = {restarts:-1, iterations:0, best_score=0}
+        self.stats = {'restarts':-1, 'iterations':0, 'best_score':0}
         self.initial = initial
         self.data = data
         self.nodes = nodes
         
         
-    def run(self):
-        #make local variables of cpt and scoring functions
-        _cpt = cpt.cpt
-        _llik = score.likelihood
+    def run(self, iterations=100):
+        """Greedy hill climbing with a decomposable score
+        
+        The score is set by the method (default 'bic') and ess keyword
+        arguments of the learner, see score.FamilyScorer.
+        """
+        #families are counted and scored once for the whole run
+        scorer = score.FamilyScorer(network.Network(self.nodes), self.data,
+                                    self.__dict__.get("method", 'bic'),
+                                    self.__dict__.get("ess", 1.0))
         
         #start with inital
         self._gen_initial()
-        self.canditate = self.initial.copy()
-        _cpt(self.candidate)
-        _llik(self.candidate)
-        self.candidate = _alter_network(self.candidate)
+        self.candidate = self.initial.copy()
+        scorer.score(self.candidate)
+        for i in xrange(iterations):
+            self.stats['iterations'] += 1
+            net = self._alter_network(self.candidate.copy())
+            if not net.is_acyclic():
+                continue
+            if scorer.score(net) > self.candidate.score:
+                self.candidate = net
+        self.stats['best_score'] = self.candidate.score
+        return self.candidate
     
     def _alter_network(self, net, add_prob=.5):
         """Alter an edge randomly in the network"""
         
         
         if N.random.sample() < add_prob:
-            #add a random edge
-            nodes = N.random.randint(len(self.nodes), size=(2,))
-            cnodes = (self.nodes[nodes[0]], self.nodes[nodes[1]])
-            while cnodes in net.edges():
-                nodes = N.random.randint(len(self.nodes), size=(2,))
-                cnodes = (self.nodes[nodes[0]], self.nodes[nodes[1]])
-            net.add_edge(cnodes[0], cnodes[1])
+            #add a random edge that respects max_parents/candidate_parents
+            net.graph.setdefault('max_parents', self.__dict__.get("max_parents", None))
+            net.graph.setdefault('candidate_parents', self.__dict__.get("candidates", None))
+            options = [(u, v) for u in self.nodes for v in self.nodes
+                        if not net.has_edge(u, v) and not net.creates_cycle(u, v) and net.edge_allowed(u, v)]
+            if options:
+                cnodes = options[N.random.randint(len(options))]
+                net.add_edge(cnodes[0], cnodes[1])
         else:
             #remove a random edge
-            net.remove_edge(net.edges[N.random.randint(len(net.edges))])
+            edges = net.edges()
+            if edges:
+                net.remove_edge(*edges[N.random.randint(len(edges))])
             
         return net
         
@@ -64,9 +79,11 @@ class Greedy(Learner):
         white = self.__dict__.get("wedges", ())
         black = self.__dict__.get("bedges", ())
         return network.random_network(self.nodes,
-                                        required_edges=white
-                                        prohibited_edges=black)
+                                        required_edges=white,
+                                        prohibited_edges=black,
+                                        max_parents=self.__dict__.get("max_parents", None),
+                                        candidates=self.__dict__.get("candidates", None))
         
     def _gen_initial(self):
-        if self.initial is not None:
+        if self.initial is None:
             self.initial = self._gen_random()
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""
+Order-space MCMC sampling of network structures (Friedman & Koller).
+
+The scores of every parent set of at most max_parents nodes are computed
+once for each node (see score.FamilyScorer).  A node ordering is then scored
+by summing, for each node, the log-sum-exp of the scores of the parent sets
+made only of nodes preceding it, so a step of the chain is a few table
+lookups instead of a pass over the data.
+
+Chains move by swapping two nodes of the ordering.  Every sampled ordering
+contributes the exact edge probabilities given that ordering, and one DAG
+drawn from it.
+
+    marginals, networks, trace = mcmc.sample(net, data, chains=4)
+"""
+
+import itertools
+import multiprocessing
+import numpy as N
+
+import network
+import score
+import instrument
+
+def _logsumexp(values):
+    top = values.max()
+    return top + N.log(N.exp(values - top).sum())
+
+class OrderMCMC(object):
+    """Precomputed parent set scores and an order-space Metropolis sampler"""
+
+    def __init__(self, net, data, method='bdeu', ess=1.0, max_parents=3, candidates=None,
+                 weights=None, processes=None):
+        """
+        PARAMETERS:
+            net         A bayesian network providing the nodes and nstates
+            data        Dataset
+            method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+            ess         equivalent sample size of 'bdeu'
+            max_parents largest parent set considered
+            candidates  dict mapping each node to its possible parents
+                        (default net.graph['candidate_parents'] or all nodes)
+            weights     multiplicity of each row of data (see util.compress)
+            processes   number of worker processes scoring the parent sets
+
+        RETURNS:
+            instance of OrderMCMC
+        """
+        nilut = net.graph['nilut']
+        self.inlut = dict(net.graph['inlut'])
+        self.n = len(nilut)
+        if self.n > 64:
+            raise ValueError("Order MCMC supports at most 64 nodes")
+        if candidates is None:
+            candidates = net.graph.get('candidate_parents', None)
+
+        #parent sets (tuples of ids) of each node
+        families = []
+        for i in xrange(self.n):
+            node = self.inlut[i]
+            options = candidates[node] if candidates is not None else net.nodes()
+            options = sorted(nilut[p] for p in options if p != node)
+            families.append([ids for k in xrange(min(max_parents, len(options)) + 1)
+                             for ids in itertools.combinations(options, k)])
+
+        scorer = score.FamilyScorer(net, data, method, ess, weights)
+        with instrument.timer('mcmc.precompute'):
+            scorer.prefetch([(self.inlut[i], [self.inlut[p] for p in ids])
+                             for i in xrange(self.n) for ids in families[i]], processes)
+
+        #per node: parent sets as bitmasks, their scores and membership matrix
+        self.masks, self.scores, self.members = [], [], []
+        for i, sets in enumerate(families):
+            self.masks.append(N.array([sum(1 << p for p in ids) for ids in sets], dtype=N.uint64))
+            self.scores.append(N.array([scorer.family(self.inlut[i], [self.inlut[p] for p in ids]) for ids in sets]))
+            members = N.zeros((len(sets), self.n), dtype=bool)
+            for row, ids in enumerate(sets):
+                members[row, list(ids)] = True
+            self.members.append(members)
+        instrument.count('mcmc.parent_sets', sum(len(sets) for sets in families))
+
+    def _compatible(self, i, allowed):
+        """Parent sets of node i made of the nodes in the bitmask allowed"""
+        return (self.masks[i] & ~N.uint64(allowed)) == 0
+
+    def node_score(self, i, allowed):
+        """log-sum-exp of the scores of the parent sets of i within allowed"""
+        return _logsumexp(self.scores[i][self._compatible(i, allowed)])
+
+    def order_score(self, order):
+        """Log score of an ordering (sequence of node ids) and of each node"""
+        terms = N.zeros(self.n)
+        allowed = 0
+        for i in order:
+            terms[i] = self.node_score(i, allowed)
+            allowed |= 1 << int(i)
+        return terms.sum(), terms
+
+    def _given_order(self, order, rand):
+        """Edge probabilities given an ordering and a DAG drawn from it
+
+        RETURNS:
+            probs       (n, n) array, probs[u, v] = P(u -> v | order)
+            parents     parent ids of each node in the drawn DAG
+            logscore    score of the drawn DAG
+        """
+        probs = N.zeros((self.n, self.n))
+        parents = [()] * self.n
+        logscore = 0.
+        allowed = 0
+        for i in order:
+            ok = N.flatnonzero(self._compatible(i, allowed))
+            w = N.exp(self.scores[i][ok] - _logsumexp(self.scores[i][ok]))
+            probs[:, i] = N.dot(w, self.members[i][ok])
+            pick = ok[rand.choice(ok.size, p=w / w.sum())]
+            parents[i] = tuple(N.flatnonzero(self.members[i][pick]))
+            logscore += self.scores[i][pick]
+            allowed |= 1 << int(i)
+        return probs, parents, logscore
+
+    def chain(self, steps=10000, burn=1000, thin=10, rand=None, order=None):
+        """Run one Metropolis chain over orderings
+
+        PARAMETERS:
+            steps       number of proposals after burn in
+            burn        number of proposals discarded first
+            thin        keep every thin-th state
+            rand        numpy RandomState
+            order       starting ordering (default random)
+
+        RETURNS:
+            marginals   (n, n) mean edge probabilities over the kept states
+            dags        list of (parents of each node, score) of the drawn DAGs
+            trace       log score of the ordering at each kept state
+        """
+        rand = N.random if rand is None else rand
+        order = rand.permutation(self.n) if order is None else N.array(order)
+        total, terms = self.order_score(order)
+
+        marginals = N.zeros((self.n, self.n))
+        dags, trace = [], []
+        accepted = 0
+        for step in xrange(burn + steps):
+            j, k = sorted(rand.choice(self.n, 2, replace=False))
+            proposal = order.copy()
+            proposal[j], proposal[k] = order[k], order[j]
+            #only the nodes between the swapped positions see new predecessors
+            allowed = 0
+            for i in order[:j]:
+                allowed |= 1 << int(i)
+            newterms = terms.copy()
+            for i in proposal[j:k+1]:
+                newterms[i] = self.node_score(i, allowed)
+                allowed |= 1 << int(i)
+            delta = newterms.sum() - total
+            if delta >= 0 or rand.rand() < N.exp(delta):
+                order, terms, total = proposal, newterms, total + delta
+                accepted += 1
+            if step >= burn and (step - burn) % thin == 0:
+                probs, parents, logscore = self._given_order(order, rand)
+                marginals += probs
+                dags.append((parents, logscore))
+                trace.append(total)
+        instrument.progress('mcmc.chain', steps=burn + steps, acceptance=float(accepted) / max(1, burn + steps))
+        return marginals / max(1, len(trace)), dags, N.array(trace)
+
+    def to_network(self, parents, logscore=None):
+        """Network of a DAG drawn by chain"""
+        net = network.Network([self.inlut[i] for i in xrange(self.n)])
+        net.add_edges_from([(self.inlut[p], self.inlut[i]) for i in xrange(self.n) for p in parents[i]])
+        net.score = logscore
+        return net
+
+def _run_chain(args):
+    """Run one chain (in a worker process)"""
+    sampler, steps, burn, thin, seed = args
+    return sampler.chain(steps, burn, thin, N.random.RandomState(seed))
+
+def sample(net, data, chains=4, steps=10000, burn=1000, thin=10, processes=None, seed=None, **kargs):
+    """Sample network structures with order MCMC
+
+    PARAMETERS:
+        net         A bayesian network providing the nodes and nstates
+        data        Dataset
+        chains      number of independent chains
+        steps       proposals per chain after burn in
+        burn        proposals discarded at the start of each chain
+        thin        keep every thin-th state of a chain
+        processes   worker processes running the chains (default one per
+                    chain, 1 runs them in this process)
+        seed        seed of the chains' random generators
+        **kargs     OrderMCMC arguments (method, ess, max_parents, ...)
+
+    RETURNS:
+        marginals   (n, n) posterior edge probabilities, [u, v] for u -> v
+                    with nodes indexed by the lookup table
+        networks    list of sampled Networks (score set to their log score)
+        trace       (chains, kept states) log scores of the orderings
+    """
+    sampler = OrderMCMC(net, data, **kargs)
+    seeds = N.random.RandomState(seed).randint(2**31 - 1, size=chains)
+    jobs = [(sampler, steps, burn, thin, s) for s in seeds]
+    processes = chains if processes is None else processes
+    if processes > 1:
+        pool = multiprocessing.Pool(min(processes, chains))
+        try:
+            results = pool.map(_run_chain, jobs)
+        finally:
+            pool.terminate()
+    else:
+        results = [_run_chain(job) for job in jobs]
+
+    marginals = N.mean([r[0] for r in results], axis=0)
+    networks = [sampler.to_network(parents, logscore) for r in results for parents, logscore in r[1]]
+    trace = N.array([r[2] for r in results])
+    return marginals, networks, trace
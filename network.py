@@ -1,11 +1,15 @@
 import numpy as N
 import networkx as nx
 import itertools
-import pydot
-import matplotlib.pyplot as plt
+import heapq
+import cpt as _cpt
+import instrument
 
 class NodeException(Exception): pass
 
+#node attributes that belong to a node's family (dropped when its parents change)
+_FAMILY_KEYS = ('cptdim', 'numer', 'denom', 'sparse', 'cpt')
+
 class Network(nx.DiGraph):
     
     def __init__(self, nodes=(), edges=tuple(), score=None):
@@ -28,6 +32,12 @@ class Network(nx.DiGraph):
             #* string representation (see Network.as_string() for format)
         
         super(Network, self).__init__()
+        #ancestors and descendants of each node as bitsets over lut ids,
+        #kept up to date as edges are added and removed
+        self._anc = {}
+        self._desc = {}
+        #Markov blankets (bitsets) computed so far
+        self._blankets = {}
         #initialize the lut in graph
         self.graph['inlut'] = {}
         self.graph['nilut'] = {}
@@ -72,10 +82,10 @@ class Network(nx.DiGraph):
     
     def _adjmat_to_edges(self, adjmat):
         """Convert adjmat to a tuple of edges"""
-        rows,cols = adjmat.shape
         nodes = self.graph['inlut']
         
-        return [(nodes[j],nodes[k]) for k in xrange(cols) for j in xrange(rows) if adjmat[j,k]]
+        cols, rows = N.nonzero(adjmat.T)
+        return [(nodes[j],nodes[k]) for k, j in zip(cols, rows)]
     
     @property
     def ordering(self):
@@ -91,6 +101,9 @@ class Network(nx.DiGraph):
         Will fail if nodes being connected by edges don't exist.
         This overrides the default behave of nx.DiGraph
         
+        The nodes of all edges are checked at once and the edges are then
+        inserted in one call to nx.DiGraph.add_edges_from.
+        
         PARAMETERS: Same parameters as add_edges_from() of nx.DiGraph
             edges
             attr_dict   
@@ -102,9 +115,18 @@ class Network(nx.DiGraph):
         
         if isinstance(edges, N.ndarray):
             edges = self._adjmat_to_edges(edges)
-            
-        for edge in edges:
-            self.add_edge(edge[0], edge[1], attr_dict=attr_dict, **attr)
+        edges = [(edge[0], edge[1]) for edge in edges]
+        
+        for u, v in edges:
+            if u not in self.node:
+                raise NodeException("Node {0} does not exist!".format(u))
+            if v not in self.node:
+                raise NodeException("Node {0} does not exist!".format(v))
+        #edges already there only get their attributes updated
+        new = list(set(e for e in edges if not self.has_edge(*e)))
+        super(Network, self).add_edges_from(edges, attr_dict=attr_dict, **attr)
+        self._touch(v for u, v in new)
+        self._link_all(new)
     
     def add_edge(self, u, v, attr_dict=None, **attr):
         """Add edge between nodes u and v.  u and v must exist otherwise exception is thrown
@@ -112,16 +134,185 @@ class Network(nx.DiGraph):
         Same parameters as add_edge() of nx.DiGraph
         """
         
-        u_exist = u in self.nodes()
+        u_exist = u in self.node
         
-        if u_exist and v in self.nodes():
+        if u_exist and v in self.node:
+            new = not self.has_edge(u, v)
             super(Network, self).add_edge(u, v, attr_dict=attr_dict, **attr)
+            if new:
+                self._touch((v,))
+                self._link(((u, v),))
         else:
             if u_exist:
                 raise NodeException("Node {0} does not exist!".format(v))
             else:
                 raise NodeException("Node {0} does not exist!".format(u))
     
+    def remove_edge(self, u, v):
+        """Same behavior as remove_edge() of nx.DiGraph"""
+        super(Network, self).remove_edge(u, v)
+        self._touch((v,))
+        self._unlink(((u, v),))
+        
+    def remove_edges_from(self, ebunch):
+        """Same behavior as remove_edges_from() of nx.DiGraph"""
+        #edges that are not there change nothing
+        ebunch = list(set((e[0], e[1]) for e in ebunch if self.has_edge(e[0], e[1])))
+        super(Network, self).remove_edges_from(ebunch)
+        self._touch(v for u, v in ebunch)
+        self._unlink(ebunch)
+        
+    def _touch(self, nodes):
+        """Forget the family and tables of nodes whose parents changed
+        
+        cptdim and the count/probability tables describe the old family, so
+        they are dropped and the next cpt.cpt counts the new family.  The
+        version is bumped so tables cached from them are rebuilt.
+        """
+        for node in nodes:
+            d = self.node[node]
+            for key in _FAMILY_KEYS:
+                d.pop(key, None)
+            d['version'] = d.get('version', 0) + 1
+        
+    def _bit(self, node):
+        return 1 << self.graph['nilut'][node]
+        
+    def _nodes_of(self, bits):
+        """Nodes of a bitset"""
+        inlut = self.graph['inlut']
+        while bits:
+            low = bits & -bits
+            yield inlut[low.bit_length() - 1]
+            bits ^= low
+            
+    def _forget_blankets(self, u, v):
+        """Drop the Markov blankets changed by the edge u->v"""
+        for node in itertools.chain((u, v), self.pred[v]):
+            self._blankets.pop(node, None)
+            
+    def _link(self, edges):
+        """Extend the ancestor/descendant sets with new edges"""
+        anc, desc = self._anc, self._desc
+        for u, v in edges:
+            above = anc.get(u, 0) | self._bit(u)
+            below = desc.get(v, 0) | self._bit(v)
+            for node in self._nodes_of(below):
+                anc[node] = anc.get(node, 0) | above
+            for node in self._nodes_of(above):
+                desc[node] = desc.get(node, 0) | below
+            self._forget_blankets(u, v)
+            
+    def _link_all(self, edges):
+        """Extend the ancestor/descendant sets with many new edges at once
+        
+        The nodes whose closures can grow are the (old) descendants of the
+        children and ancestors of the parents; they are rebuilt in one
+        topological sweep instead of one walk per edge.
+        """
+        if len(edges) <= 1:
+            self._link(edges)
+            return
+        below = above = 0
+        for u, v in edges:
+            below |= self._desc.get(v, 0) | self._bit(v)
+            above |= self._anc.get(u, 0) | self._bit(u)
+        self._blankets.clear()
+        self._reclose(below, self._anc, self.pred, self.succ)
+        self._reclose(above, self._desc, self.succ, self.pred)
+        
+    def _unlink(self, edges):
+        """Rebuild the ancestor/descendant sets touched by removed edges
+        
+        Only the (old) descendants of the children and ancestors of the
+        parents can have changed; they are rebuilt from their neighbors.
+        """
+        if not edges:
+            return
+        below = above = 0
+        for u, v in edges:
+            below |= self._desc.get(v, 0) | self._bit(v)
+            above |= self._anc.get(u, 0) | self._bit(u)
+            self._forget_blankets(u, v)
+        self._reclose(below, self._anc, self.pred, self.succ)
+        self._reclose(above, self._desc, self.succ, self.pred)
+        
+    def _reclose(self, bits, closure, inward, outward):
+        """Recompute closure[node] = union of closure[x] | x over inward[node]
+        for the nodes of bits, inward neighbors first"""
+        nilut = self.graph['nilut']
+        get = closure.get
+        nodes = set(self._nodes_of(bits))
+        waiting = dict((node, len(nodes.intersection(inward[node]))) for node in nodes)
+        ready = [node for node, k in waiting.iteritems() if k == 0]
+        while ready:
+            node = ready.pop()
+            del waiting[node]
+            bits = 0
+            for x in inward[node]:
+                bits |= get(x, 0) | (1 << nilut[x])
+            closure[node] = bits
+            for y in outward[node]:
+                if y in waiting:
+                    waiting[y] -= 1
+                    if waiting[y] == 0:
+                        ready.append(y)
+        #nodes on a cycle: iterate to the fixpoint
+        changed = bool(waiting)
+        while changed:
+            changed = False
+            for node in waiting:
+                bits = 0
+                for x in inward[node]:
+                    bits |= get(x, 0) | (1 << nilut[x])
+                if bits != closure.get(node, 0):
+                    closure[node] = bits
+                    changed = True
+                    
+    def ancestor_bits(self, node):
+        """Ancestors of node as a bitset (bit i is the node with lut id i)"""
+        return self._anc.get(node, 0)
+        
+    def descendant_bits(self, node):
+        """Descendants of node as a bitset (bit i is the node with lut id i)"""
+        return self._desc.get(node, 0)
+        
+    def ancestors(self, node):
+        """Set of the ancestors of node"""
+        return set(self._nodes_of(self.ancestor_bits(node)))
+        
+    def descendants(self, node):
+        """Set of the descendants of node"""
+        return set(self._nodes_of(self.descendant_bits(node)))
+        
+    def blanket_bits(self, node):
+        """Markov blanket of node (parents, children and the children's other
+        parents) as a bitset, cached until an edge around node changes"""
+        bits = self._blankets.get(node, None)
+        if bits is None:
+            bits = 0
+            for x in self.pred[node]:
+                bits |= self._bit(x)
+            for child in self.succ[node]:
+                bits |= self._bit(child)
+                for x in self.pred[child]:
+                    bits |= self._bit(x)
+            bits &= ~self._bit(node)
+            self._blankets[node] = bits
+        return bits
+        
+    def markov_blanket(self, node):
+        """Set of the nodes in the Markov blanket of node"""
+        return set(self._nodes_of(self.blanket_bits(node)))
+        
+    def nodes_of(self, bits):
+        """List of the nodes of a bitset"""
+        return list(self._nodes_of(bits))
+        
+    def creates_cycle(self, u, v):
+        """True if adding the edge u->v would make the network cyclic"""
+        return u == v or bool(self._desc.get(v, 0) & self._bit(u))
+        
     def clear(self):
         """Clear all edges from network, but keep nodes"""
         self.remove_edges_from(self.edges())
@@ -158,60 +349,97 @@ class Network(nx.DiGraph):
         return [n for n in nodes() if n in node_ids]
         #return dict((k, self.nodeids[k]) for k in node_ids)
         
+    def edge_allowed(self, u, v):
+        """Check edge u->v against the search space constraints of the network
+        
+        graph['max_parents'] bounds the in-degree of every node and
+        graph['candidate_parents'] maps each node to the parents it may have
+        (see score.candidate_parents).  Both are optional.
+        
+        PARAMETERS:
+            u, v        nodes of the edge
+            
+        RETURNS:
+            bool        True if adding u->v respects the constraints
+        """
+        max_parents = self.graph.get('max_parents', None)
+        if max_parents is not None and len(self.pred[v]) >= max_parents:
+            return False
+        candidates = self.graph.get('candidate_parents', None)
+        if candidates is not None and u not in candidates[v]:
+            return False
+        return True
+        
     def is_acyclic(self):
         """Uses a depth-first search (dfs) to detect cycles."""
 
-        return nx.is_directed_acyclic_graph(self)    
+        with instrument.timer('acyclic'):
+            return nx.is_directed_acyclic_graph(self)
         
     def cpt(self, node, state):
         """Return the cpt of state
         Since numer and denom are tracked separately,
         this function will divide the two and return the result
         
+        The division is done once per node (see cpt.probcpt) and cached until
+        the node's counts or parents change.
+        
         PARAMETERS:
             node        Node of which to calculate the conditional  probability
             state       State of which to calculate the conditional probability
             
         RETURNS:
-            None
+            float       conditional probability (0 if no data was collected)
         """
         
-        if isinstance(node, int):
-            node = self.graph['nilut'][node]
-            
-        if node in self.node:
-            n = self.node[node].get('numer', None)
-            d = self.node[node].get('denom', None)
-            
-            #we don't have frequency counts, so try for existing cpt table
-            if n is None or d is None:
-                try:
-                    return self.node[node]['cpt'][state]
-                except IndexError:
-                    raise IndexError("Invalid state: ", state)
-                except KeyError:
-                    raise StandardError("No CPT table in this node")
-                except:
-                    raise Exception("Something went wrong... :(")
-                    
+        node = self._cpt_node(node)
+        #sparse count tables (see cpt.SparseCPT)
+        s = self.node[node].get('sparse', None)
+        if s is not None:
             try:
-                top = float(n[state])
-                bottom = d[state]
-                if d[state] == 0:
-                    raise ZeroDivisionError
-                else:
-                    return float(n[state])/d[state]
-            except IndexError:
+                return s.prob(state)
+            except ValueError:
                 raise IndexError("Invalid state: ", state)
-            except ZeroDivisionError:
-                #no data has been collected, so assume 0 probability
-                return 0.
-            except:
-                raise Exception("Something went wrong... :(")
-        else:
+            
+        try:
+            return float(_cpt.probcpt(self, node)[state])
+        except IndexError:
+            raise IndexError("Invalid state: ", state)
+            
+    def cpt_many(self, node, states):
+        """Vectorized cpt: conditional probability of each row of states
+        
+        PARAMETERS:
+            node        Node of which to calculate the conditional probability
+            states      2d array, one family state per row (cptdim order)
+            
+        RETURNS:
+            ndarray     conditional probability of each row
+        """
+        
+        node = self._cpt_node(node)
+        states = N.atleast_2d(states).astype(N.int64)
+        s = self.node[node].get('sparse', None)
+        if s is not None:
+            return s.probs(states)
+        
+        table = _cpt.probcpt(self, node)
+        if states.shape[1] != table.ndim:
+            raise IndexError("Expected family states of length {0}".format(table.ndim))
+        try:
+            return table[tuple(states.T)]
+        except IndexError:
+            raise IndexError("Invalid state in states")
+            
+    def _cpt_node(self, node):
+        """Label of node given by label or lookup table id"""
+        if isinstance(node, int) and node not in self.node:
+            node = self.graph['inlut'].get(node, node)
+        if node not in self.node:
             raise StandardError("Node {0} doesn't exist!".format(node))
+        return node
         
-    def jointprob(self, states):
+    def jointprob(self, states, marginalize=False):
         """Calculate the joint probability of state (2d numpy array)
         Each row is a state vector, and each column the state values
         
@@ -227,46 +455,98 @@ class Network(nx.DiGraph):
         
         PARAMETERS:
             states      States to use in calculating the joint probability
+            marginalize sum out missing cells (see logprob)
             
         RETURNS:
             ndarray     two column array. first column are states
                         second column are the caculated joint probabilities for those states
         """
         states = N.atleast_2d(states)
-        probs = N.zeros(states.shape)
-        probs.fill(N.finfo(float).tiny)
-        _node = self.node
-        _graph = self.graph
-        for index in N.ndindex(states.shape):
-            #i=variable index, v=state value
-            
-            #get variable label
-            var = _graph['inlut'][index[1]]
-            #get the variable cpt dimensions (these are the parents of var)
-            var_pred = _node[var]['cptdim']
-            #get the parents node ids
-            var_pred_ind = [_graph['nilut'][x] for x in var_pred]
+        return N.c_[states, self.logprob(states, marginalize)]
+        
+    def logprob(self, states, marginalize=False):
+        """Calculate the log joint probability of each row of states (2d numpy array)
+        
+        Uses the cached log probability tables of the nodes (see cpt.logcpt),
+        so each node costs one gather over all rows.  Zero probabilities count
+        as the smallest positive float, as in jointprob.
+        
+        Missing cells (cpt.MISSING) either drop the families they appear in
+        or, with marginalize, are summed out: rows sharing a pattern of
+        missing cells are scored together over the completions of the
+        missing cells that matter (see cpt.marginal_plan).
+        
+        PARAMETERS:
+            states      States to use in calculating the joint probability
+            marginalize sum out missing cells instead of dropping families
             
-            try:
-                #we already have numeric states
-                cptstate = tuple([states[index[0],p] for p in var_pred_ind])
-            except KeyError:
-                #if we already have state indexes
-                cptstate = tuple([_node[v]['states_ind'][states[index[0],p]] for v, p in zip(var_pred, var_pred_ind)])
-            except:                
-                print "Invalid state: no state {1}".format(states[index[0],p])
+        RETURNS:
+            ndarray     log joint probability of each row
+        """
+        states = N.atleast_2d(states)
+        if marginalize:
+            return self._marginal_logprob(_cpt.as_states(states))
+        #one accumulator column (float32 in compact mode, see cpt.set_compact)
+        probsl = N.zeros(states.shape[0], dtype=_cpt.float_dtype())
+        instrument.count('jointprob.rows', states.shape[0])
+        with instrument.timer('jointprob'):
+            for var in self.graph['inlut'].itervalues():
+                probsl += _cpt.family_logprob(self, var, states)
+        return probsl
+        
+    def _marginal_logprob(self, states, blocksize=2**20, maxcompletions=_cpt.MAX_COMPLETIONS):
+        """logprob of each row with its missing cells summed out
+        
+        Observed families are scored once per row and barren missing nodes
+        are dropped.  The other missing cells are summed out one component
+        at a time (see cpt.marginal_plan), the families of a component with
+        more than maxcompletions completions are left out and reported.
+        blocksize bounds the number of completed rows scored at once.
+        """
+        probsl = N.zeros(states.shape[0])
+        for cols, rows in _cpt.missing_patterns(states):
+            if not cols:
+                probsl[rows] = self.logprob(states[rows])
                 continue
-            
-            #print var, cptstate
-            #print self.node[var]['cpt'].shape
-            cptprob = self.cpt(var, cptstate)
-            #print cptprob
-            probs[index] = cptprob if cptprob != 0. else probs[index]
-            
+            fixed, components, dropped = _cpt.marginal_plan(self, cols, maxcompletions)
+            for node in fixed:
+                probsl[rows] += _cpt.family_logprob(self, node, states[rows])
+            for members, nodes, total in dropped:
+                instrument.progress('logprob.dropped_families', rows=rows.size, columns=members,
+                                    completions=total, families=len(nodes))
+            for members, nodes, total in components:
+                chunk = min(total, blocksize)
+                step = max(1, blocksize // chunk)
+                assignments = _cpt.completions(self, members) if chunk == total else None
+                for start in xrange(0, rows.size, step):
+                    block = rows[start:start+step]
+                    norm = N.empty(block.size)
+                    norm.fill(-N.inf)
+                    for first in xrange(0, total, chunk):
+                        if chunk < total:
+                            assignments = _cpt.completions(self, members, first, first + chunk)
+                        logp = _cpt.completion_logprob(self, nodes, states[block], members, assignments)[1]
+                        norm = N.logaddexp(norm, _cpt.logsumexp(logp, axis=1))
+                    probsl[block] += norm
+        return probsl
+        
+    def logcontrib(self, states):
+        """Log probability contribution of each node for each row of states
+        
+        Column i holds log P(node i | parents) where i is the node's index in
+        the lookup table, so the row sums equal logprob(states).
         
-        probsl = N.sum(N.log(probs), axis=1)
-        return N.c_[states, probsl]
-        #return zip(states, probs)
+        PARAMETERS:
+            states      States to use in calculating the contributions
+            
+        RETURNS:
+            ndarray     (rows, nodes) array of log probabilities
+        """
+        states = N.atleast_2d(states)
+        contrib = N.zeros(states.shape, dtype=_cpt.float_dtype(), order='F')
+        for vari, var in self.graph['inlut'].iteritems():
+            contrib[:,vari] = _cpt.family_logprob(self, var, states)
+        return contrib
        
     def layout(self, prog="dot", args=''): 
         """Determines network layout using Graphviz's dot algorithm.
@@ -277,8 +557,8 @@ class Network(nx.DiGraph):
         The resulting node positions are saved in network.node_positions.
 
         """
-
-        self.node_positions = nx.graphviz_layout(self, prog=prog, args=args)
+        import draw
+        self.node_positions = draw.layout(self, prog=prog, args=args)
     
     def as_dotstring(self):
         """Returns network as a dot-formatted string"""
@@ -287,73 +567,163 @@ class Network(nx.DiGraph):
 
     def as_dotfile(self, filename):
         """Saves network as a dot file."""
-
-        nx.write_dot(self, filename)
+        import draw
+        draw.as_dotfile(self, filename)
 
     def as_pydot(self):
         """Returns a pydot instance for the network."""
-
-        return nx.to_pydot(self)
+        import draw
+        return draw.as_pydot(self)
     
 ################################################################################
 #Factory Functions
 ################################################################################
-def random_network(nodes, required_edges=(), prohibited_edges=(), max_attempts=50):
+def _random_order(n_nodes, required, rand):
+    """Random topological order of the graph of required edges
+    
+    Kahn's algorithm with random priorities, so every order consistent
+    with the required edges can be drawn.
+    
+    PARAMETERS:
+        n_nodes     number of nodes
+        required    (n, n) boolean adjacency matrix of required edges
+        rand        random generator (numpy.random or a RandomState)
+        
+    RETURNS:
+        ndarray     node indexes in topological order
+    """
+    priority = rand.rand(n_nodes)
+    indegree = required.sum(axis=0)
+    ready = [(priority[i], i) for i in N.flatnonzero(indegree == 0)]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        p, i = heapq.heappop(ready)
+        order.append(i)
+        for j in N.flatnonzero(required[i]):
+            indegree[j] -= 1
+            if indegree[j] == 0:
+                heapq.heappush(ready, (priority[j], j))
+    if len(order) != n_nodes:
+        raise ValueError("Required edges contain a cycle")
+    return N.array(order)
+
+def random_adjmats(n_nodes, count=1, required=None, prohibited=None, density=None,
+                   max_parents=None, rand=None):
+    """Sample adjacency matrices of random DAGs
+    
+    Each DAG draws a random topological order (consistent with the required
+    edges) and then keeps every pair consistent with that order with
+    probability density, so no sample is ever rejected for being cyclic.
+    
+    PARAMETERS:
+        n_nodes         number of nodes
+        count           number of DAGs to sample
+        required        (n, n) boolean matrix of edges that must be present
+        prohibited      (n, n) boolean matrix of edges that must be absent
+        density         probability of an edge between two nodes
+                        (default 2/n_nodes, about n_nodes-1 edges)
+        max_parents     maximum in-degree of a node.  Required edges are
+                        always kept, other parents are dropped at random.
+        rand            random generator (numpy.random or a RandomState)
+        
+    RETURNS:
+        ndarray         (count, n, n) boolean adjacency matrices
+    """
+    rand = rand or N.random
+    shape = (n_nodes, n_nodes)
+    required = N.zeros(shape, dtype=bool) if required is None else N.asarray(required, dtype=bool)
+    prohibited = N.zeros(shape, dtype=bool) if prohibited is None else N.asarray(prohibited, dtype=bool)
+    density = min(1.0, 2.0/max(n_nodes, 1)) if density is None else density
+    if N.any(required & prohibited):
+        raise ValueError("An edge is both required and prohibited")
+    if max_parents is not None and N.any(required.sum(axis=0) > max_parents):
+        raise ValueError("Required edges exceed max_parents")
+    
+    #position of each node in a random topological order
+    if required.any():
+        orders = N.array([_random_order(n_nodes, required, rand) for i in xrange(count)])
+    else:
+        orders = N.argsort(rand.rand(count, n_nodes), axis=1)
+    pos = N.empty_like(orders)
+    pos[N.arange(count)[:,None], orders] = N.arange(n_nodes)
+    
+    #an edge i->j may only go forward in the order
+    allowed = (pos[:,:,None] < pos[:,None,:]) & ~prohibited
+    adj = (allowed & (rand.rand(count, n_nodes, n_nodes) < density)) | required
+    
+    if max_parents is not None:
+        #rank the parents of each node, required ones first, and keep the best
+        priority = N.where(adj, rand.rand(count, n_nodes, n_nodes), N.inf)
+        priority[:,required] = -1.0
+        rank = N.argsort(N.argsort(priority, axis=1), axis=1)
+        adj &= rank < max_parents
+    
+    return adj
+
+def random_networks(nodes, count, required_edges=(), prohibited_edges=(), density=None,
+                    max_parents=None, candidates=None, rand=None):
+    """Creates count random networks with the given set of nodes.
+    
+    See random_adjmats for how the networks are drawn.
+    
+    PARAMETERS:
+        nodes                   nodes to have in network
+        count                   number of networks
+        required_edges          edges required to be present in network
+        prohibited_edges        edges required to not be present in network
+        density                 probability of an edge between two nodes
+        max_parents             maximum number of parents of a node
+        candidates              dict mapping each node to the parents it
+                                may have (see score.candidate_parents)
+        rand                    random generator (numpy.random or a RandomState)
+        
+    RETURNS:
+        list            Random networks
+    """
+    nodes = list(nodes)
+    n_nodes = len(nodes)
+    lut = {n:i for i, n in enumerate(nodes)}
+    required = N.zeros((n_nodes, n_nodes), dtype=bool)
+    for src, dest in required_edges:
+        required[lut[src], lut[dest]] = True
+    prohibited = N.zeros((n_nodes, n_nodes), dtype=bool)
+    for src, dest in prohibited_edges:
+        prohibited[lut[src], lut[dest]] = True
+    if candidates is not None:
+        allowed = N.zeros((n_nodes, n_nodes), dtype=bool)
+        for dest, parents in candidates.iteritems():
+            allowed[[lut[p] for p in parents], lut[dest]] = True
+        prohibited |= ~allowed & ~required
+        
+    adjmats = random_adjmats(n_nodes, count, required, prohibited, density, max_parents, rand)
+    return [Network(nodes, adjmat) for adjmat in adjmats]
+    
+def random_network(nodes, required_edges=(), prohibited_edges=(), max_attempts=50, density=None,
+                   max_parents=None, candidates=None, rand=None):
     """Creates a random network with the given set of nodes.
 
     Can specify required_edges and prohibited_edges to control the resulting
     random network.  
     
-    max_attempts sets how many times to try to achieve the criteria.
-    If we use up all max_attempts we cut density in half and try again.
+    Edges are drawn consistent with a random topological order, so the
+    network is acyclic by construction (see random_adjmats).
     
     PARAMETERS:
         nodes                   nodes to have in network
         required_edges          edges required to be present in network
         prohibited_edges        edges required to not be present in network
-        max_attempts            max number of attempts to create a random network
+        max_attempts            unused, kept for backwards compatibility
+        density                 probability of an edge between two nodes
+        max_parents             maximum number of parents of a node
+        candidates              dict mapping each node to the parents it may have
+        rand                    random generator (numpy.random or a RandomState)
         
     RETURNS:
         Network         A random network
     """
-    def _randomize(net, density=None):
-        net.clear()
-        n_nodes = len(net.nodes())
-        nodes = net.graph['nilut']
-        density = density or 1.0/n_nodes
-
-        for attempt in xrange(max_attempts):
-            # create an random adjacency matrix with given density
-            adjmat = N.random.rand(n_nodes, n_nodes)
-            adjmat[adjmat >= (1.0-density)] = 1
-            adjmat[adjmat != 1] = 0
-            
-            # add required edges
-            for src,dest in required_edges:
-                adjmat[nodes[src], nodes[dest]] = 1
-
-            # remove prohibited edges
-            for src,dest in prohibited_edges:
-                adjmat[nodes[src], nodes[dest]] = 0
-
-            # remove self-loop edges (those along the diagonal)
-            N.fill_diagonal(adjmat, 0)
-            
-            # set the adjaceny matrix and check for acyclicity
-            net.add_edges_from(adjmat)
-
-            if net.is_acyclic():
-                return net
-
-        # got here without finding a single acyclic network.
-        # so try with a less dense network
-        return _randomize(net, density=density/2.0)
-
-    # -----------------------
-    
-    net = Network(nodes)
-    
-    return _randomize(net)
+    return random_networks(nodes, 1, required_edges, prohibited_edges, density,
+                           max_parents, candidates, rand)[0]
     
 def randomDAG(nodes, white_edges=(), black_edges=(), prob=.5):
     """Generate a random DAG
@@ -361,24 +731,14 @@ def randomDAG(nodes, white_edges=(), black_edges=(), prob=.5):
     PARAMETERS:
         nodes           Nodes to have present in network
         white_edges     edges required to be present in network
-        black_edges     not implemented yet
+        black_edges     edges required to not be present in network
         prob            probability of adding an edge
         
     RETURNS:
         Network         A random directed acyclic graph
     """
     
-    #shuffle the nodes
-    N.random.shuffle(nodes)
-    
-    #add the white edges
-    net = Network(nodes, white_edges)
-    
-    for e in itertools.combinations(nodes, 2):
-        if N.random.randn() < prob:
-            net.add_edge(*e)
-    
-    return net
+    return random_network(nodes, white_edges, black_edges, density=prob)
     
 def dist(net1, net2):
     """Return the distance between two networks
@@ -416,39 +776,11 @@ def is_strongly_connected(G):
         return nx.strongly_connected.is_strongly_connected(G)
 
 def drawnet(g):
-    nx.draw_graphviz(g)
-    plt.show()
+    """Draw a network with matplotlib (see draw.drawnet)"""
+    import draw
+    return draw.drawnet(g)
     
 def pydotnet(control, cand, colorsame='black', controldiff='purple', canddiff='red'):
-    """nets is a sequence of network objects.  The edges of the first are taken to be
-    the universal set
-    
-    colorsame = color common edges
-    color diffenrent = color unique edges
-    """
-    
-    pdnet = pydot.Dot(graph_type='digraph')
-    
-    #add the nodes to the Graph
-    nodes = control.nodes()
-    [pdnet.add_node(n) for n in map(pydot.Node, nodes)]
-    
-    edges = [set(n.edges()) for n in (control, cand)]
-    
-    #intersection give edges in both networks
-    sameedges = set.intersection(*edges)
-    #get the unique edges in each network
-    controluniqedges = set(control.edges())-sameedges
-    canduniqedges = set(cand.edges())-sameedges
-    
-    samecol = lambda e: pydot.Edge(*e, color=colorsame)
-    diffcol = lambda e: pydot.Edge(*e, color=controldiff, style='dashed')
-    uniquecol = lambda e: pydot.Edge(*e, color=canddiff)
-    [pdnet.add_edge(e) for e in map(samecol, sameedges)]
-    [pdnet.add_edge(e) for e in map(diffcol, controluniqedges)]
-    [pdnet.add_edge(e) for e in map(uniquecol, canduniqedges)]
-    print "Same Edges: ",len(sameedges)
-    print "Control Edges: ", len(controluniqedges)
-    print "Cand Edges: ", len(canduniqedges)
-    return pdnet
-    
\ No newline at end of file
+    """Compare two networks in a pydot graph (see draw.pydotnet)"""
+    import draw
+    return draw.pydotnet(control, cand, colorsame, controldiff, canddiff)
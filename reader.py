@@ -1,12 +1,172 @@
+import re
+import itertools
 import network
 import numpy as N
+import instrument
+import cpt
+import discretize as _discretize
 
-def csv2bnet(filename, names=True, **kargs):
+#raw values read as missing (encoded as cpt.MISSING)
+MISSING_VALUES = ('', 'NA', 'nan', '?')
+
+def missing_mask(column, missing=MISSING_VALUES):
+    """Boolean mask of the missing values of a (masked) column"""
+    mask = N.ma.getmaskarray(column)
+    values = N.ma.getdata(column)
+    return mask | N.array([str(s) in missing for s in values], dtype=bool)
+
+def encode(column, states_ind, missing=MISSING_VALUES):
+    """Encode a column of raw values into state indexes
+    
+    PARAMETERS:
+        column          values read from a csv file (may be masked)
+        states_ind      map from state name to state index
+        missing         raw values encoded as cpt.MISSING
+        
+    RETURNS:
+        ndarray         state indexes (float)
+    """
+    mask = missing_mask(column, missing)
+    values = N.ma.getdata(column)
+    return N.array([cpt.MISSING if m else states_ind[str(s)] for s, m in zip(values, mask)], dtype=float)
+    
+def numeric(column, missing=MISSING_VALUES):
+    """Values of a numeric column as floats, missing values as nan"""
+    mask = missing_mask(column, missing)
+    values = N.asarray(N.ma.getdata(column))
+    if values.dtype.kind in 'SUO':
+        #raw strings, missing markers are not parseable
+        values = N.where(mask, 'nan', values)
+    values = values.astype(float)
+    values[mask] = N.nan
+    return values
+    
+def _str2bool(s):
+    """Parse a boolean as numpy.genfromtxt does"""
+    s = s.upper()
+    if s == 'TRUE':
+        return N.bool_(True)
+    elif s == 'FALSE':
+        return N.bool_(False)
+    raise ValueError("Not a boolean: {0}".format(s))
+    
+#parsers of the column types numpy.genfromtxt infers, by dtype kind
+_PARSERS = {'b': _str2bool, 'i': N.int64, 'f': N.float64}
+
+def column_kind(net, node):
+    """dtype kind ('b', 'i', 'f' or 'S') of the column node was loaded from
+    
+    csv2bnet records it on the node.  For other networks it is guessed from
+    the state names: the first type that parses every name back to itself.
+    """
+    d = net.node[node]
+    if 'kind' in d:
+        return d['kind']
+    elif 'edges' in d:
+        return 'f'
+    names = list(d.get('states_ind', ()))
+    if not names:
+        return 'S'
+    for kind in ('b', 'i', 'f'):
+        try:
+            if all(str(_PARSERS[kind](name)) == name for name in names):
+                return kind
+        except ValueError:
+            pass
+    return 'S'
+    
+def as_loaded(column, kind, missing=MISSING_VALUES):
+    """State names of raw values as csv2bnet names them
+    
+    The loader parses a whole column with one type and names the states by
+    str() of the parsed values, so '1.50' is the state '1.5' of a float
+    column and '007' the state '7' of an int column.  Values that do not
+    parse as kind keep their text.
+    
+    PARAMETERS:
+        column          raw values (may be masked)
+        kind            dtype kind of the loaded column (see column_kind)
+        missing         raw values encoded as cpt.MISSING
+        
+    RETURNS:
+        masked array    state names, missing values masked
+    """
+    mask = missing_mask(column, missing)
+    values = N.ma.getdata(column)
+    parse = _PARSERS.get(kind, str)
+    names = []
+    for s, m in zip(values, mask):
+        s = str(s)
+        if not m:
+            try:
+                s = str(parse(s))
+            except ValueError:
+                pass
+        names.append(s)
+    return N.ma.array(names, mask=mask)
+    
+def extend_states(net, node, column, missing=MISSING_VALUES):
+    """Add the values of column that are not states of node yet
+    
+    New states get the next indexes and the count tables of the network
+    are enlarged for them (see cpt.grow_states).
+    
+    RETURNS:
+        list            names of the new states
+    """
+    d = net.node[node]
+    states_ind = d.setdefault('states_ind', {})
+    ind_states = d.setdefault('ind_states', {})
+    mask = missing_mask(column, missing)
+    values = N.ma.getdata(column)
+    new = sorted(set(str(s) for s, m in zip(values, mask) if not m) - set(states_ind))
+    if new:
+        for name in new:
+            i = len(states_ind)
+            states_ind[name] = i
+            ind_states[i] = name
+        cpt.grow_states(net, node, len(states_ind))
+    return new
+    
+def read_chunks(filename, chunksize=10000, delimiter=','):
+    """Read a csv file with a header row in chunks of rows
+    
+    Chunks are parsed by numpy.recfromcsv as csv2bnet parses a whole file
+    (same column names, stripping, comments and masking), but every value
+    is kept as text: the type of a column cannot be told from one chunk
+    (see as_loaded).
+    
+    PARAMETERS:
+        filename        csv file
+        chunksize       rows per chunk
+        delimiter       field delimiter
+        
+    RETURNS:
+        generator of masked record arrays of raw values
+    """
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        for lines in iter(lambda: list(itertools.islice(f, chunksize)), []):
+            #no field is longer than its line
+            dtype = 'S{0}'.format(max(len(line) for line in lines))
+            chunk = N.recfromcsv([header] + lines, delimiter=delimiter, names=True, autostrip=True,
+                                 case_sensitive=True, usemask=True, dtype=dtype)
+            #a single row parses as a 0-d array
+            yield N.ma.atleast_1d(chunk)
+
+def csv2bnet(filename, names=True, missing=MISSING_VALUES, discretize=None, bins=5, target=None, **kargs):
     """Read a csv file into and return a bnet object
     
     PARAMETERS:
         filename        CSV to use in creating network
         names           are the names of the nodes the first row?
+        missing         values read as missing instead of as a state
+        discretize      discretization of continuous columns (see the
+                        discretize module): a method ('width', 'quantile'
+                        or 'mdl') applied to every floating point column,
+                        or a dict mapping column names to methods
+        bins            number of bins of 'width' and 'quantile'
+        target          categorical column supervising 'mdl'
         **kargs         additional arguments for numpy.recfromcsv
         
     RETURNS:
@@ -14,48 +174,124 @@ def csv2bnet(filename, names=True, **kargs):
         dataset         dataset as numpy array
     """
     
-    data = N.recfromcsv(filename, delimiter=",", names=names, autostrip=True, case_sensitive=True, **kargs)
+    kargs.setdefault('usemask', True)
+    with instrument.timer('load'):
+        data = N.recfromcsv(filename, delimiter=",", names=names, autostrip=True, case_sensitive=True, **kargs)
+    instrument.count('load.rows', data.size)
     
     #make network with named nodes
     net = network.Network(data.dtype.names)
     m, n = data.size, len(data.dtype.names)
     dataset = N.zeros((m, n), order='F')
+    
+    if isinstance(discretize, str):
+        discretize = {node:discretize for node in data.dtype.names if data[node].dtype.kind == 'f'}
+    discretize = discretize or {}
+    
     #set up a map for each node that maps the states to an numeric value
     for node, d in net.node.iteritems():
-        states = N.unique(data[node])
+        if node in discretize:
+            continue
+        column = data[node]
+        states = N.unique(N.ma.getdata(column)[~missing_mask(column, missing)])
+        #type of the column, chunks are parsed like it (see as_loaded)
+        d['kind'] = column.dtype.kind
         d['nstates'] = states.size
         dstates = {str(name):stateID for stateID, name in enumerate(states)}
         d['states_ind'] = dstates
         d['ind_states'] = {stateID:name for name, stateID in dstates.iteritems()}
-        dataset[:,net.graph['nilut'][node]] = [dstates[str(s)] for s in data[node]]
+        dataset[:,net.graph['nilut'][node]] = encode(column, dstates, missing)
+    
+    #bin the continuous columns, edges are kept on the nodes
+    for node, method in discretize.iteritems():
+        values = numeric(data[node], missing)
+        labels = dataset[:,net.graph['nilut'][target]] if target is not None else None
+        edges = _discretize.fit_edges(values, method, bins, labels)
+        _discretize.set_states(net, node, edges)
+        dataset[:,net.graph['nilut'][node]] = _discretize.apply(values, edges)
 
+    if cpt.COMPACT:
+        dataset = cpt.compact_states(dataset, max(d['nstates'] for d in net.node.itervalues()))
     return [net, dataset]
     
+#node names in a modelstring: "double quoted", `backquoted` or plain
+_NAME = r'"(?:[^"\\]|\\.)*"|`[^`]*`|[^\s\[\]|:"`]+'
+_FAMILY = re.compile(r'\s*\[\s*({0})\s*(?:\|\s*((?:{0})(?:\s*:\s*(?:{0}))*)\s*)?\]\s*'.format(_NAME))
+_PARENT = re.compile(_NAME)
+#names that have to be quoted when writing a modelstring
+_PLAIN = re.compile(r'^[^\s\[\]|:"`]+$')
+
+def _unquote(name):
+    """Strip the quotes of a modelstring name"""
+    if name.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    elif name.startswith('`'):
+        return name[1:-1]
+    return name
+    
+def _quote(name):
+    """Quote a name for a modelstring if needed"""
+    name = str(name)
+    if _PLAIN.match(name):
+        return name
+    return '"{0}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
 def parsemodel(s, nodeorder=None, net=None):
     """Parse a modelstring to Bayes Net
     
     Format is as follows [Child|Parent:Parent:...]
     
+    Whitespace around names and separators is ignored.  Names containing
+    whitespace or any of []|:"` can be written "double quoted" (with \\"
+    escapes) or `backquoted`.  All edges are added in one bulk insertion.
+    
     PARAMETERS:
         s               string representation of network
-        nodeorder       string of all nodes separated by spaces
+        nodeorder       string of all nodes separated by spaces (or a list).
+                        Default is the order of the families in s.
         net             Network instance to use in building network
         
     RETURN:
         Network         instance of Network
     """
-    nodes = [t[:-1].split("|") for t in s.split("[") if t]
+    children = []
+    edges = []
+    pos = 0
+    end = len(s.rstrip())
+    while pos < end:
+        match = _FAMILY.match(s, pos)
+        if match is None:
+            raise ValueError("Invalid modelstring at position {0}: {1!r}".format(pos, s[pos:pos+20]))
+        child = _unquote(match.group(1))
+        children.append(child)
+        if match.group(2):
+            edges.extend((_unquote(p), child) for p in _PARENT.findall(match.group(2)))
+        pos = match.end()
     
     if net is None:
         if isinstance(nodeorder, str):
             nodeorder = nodeorder.split()
-        net = network.Network(nodeorder)
-    for n in nodes:
-        try:
-            child, parents = n
-            edges = [(p, child) for p in parents.split(":")]
-            net.add_edges_from(edges)
-        except ValueError:
-            #no edge to add
-            continue
-    return net
\ No newline at end of file
+        net = network.Network(children if nodeorder is None else nodeorder)
+    net.add_edges_from(edges)
+    return net
+    
+def to_modelstring(net):
+    """Write a network as a modelstring (the inverse of parsemodel)
+    
+    Families are written in the order of the network's lookup table, parents
+    sorted by name as bnlearn does.
+    
+    PARAMETERS:
+        net             instance of Network
+        
+    RETURN:
+        str             modelstring [Child|Parent:Parent:...]...
+    """
+    families = []
+    for node in net.ordering:
+        parents = sorted(net.pred[node], key=str)
+        if parents:
+            families.append('[{0}|{1}]'.format(_quote(node), ':'.join(_quote(p) for p in parents)))
+        else:
+            families.append('[{0}]'.format(_quote(node)))
+    return ''.join(families)
@@ -1,5 +1,26 @@
+import multiprocessing
 import numpy as N
 import util
+import cpt
+import instrument
+
+#log gamma function, looked up on first use (see _gammaln)
+_GAMMALN = []
+
+def _gammaln():
+    """scipy's gammaln, or math.lgamma vectorized without scipy.  Imported
+    lazily so that importing the core modules does not import scipy."""
+    if not _GAMMALN:
+        try:
+            from scipy.special import gammaln
+        except ImportError:
+            import math
+            gammaln = N.vectorize(math.lgamma, otypes=[float])
+        _GAMMALN.append(gammaln)
+    return _GAMMALN[0]
+
+#decomposable scores understood by family_score and FamilyScorer
+SCORES = ('loglik', 'bic', 'aic', 'bdeu', 'k2')
 
 def likelihood(net, data, nodes=()):
     """Calculate the log likelihood of a network
@@ -23,8 +44,6 @@ def likelihood(net, data, nodes=()):
     #build a lookup table for all the nodes based on their idb
     #this gives our column indices for the different variables
     ll = N.zeros(data.shape, order='F')
-    predd = net.pred
-    nodedict = net.node
     lut = net.graph['nilut']
     
     if nodes:
@@ -33,21 +52,12 @@ def likelihood(net, data, nodes=()):
         iternodes = lut
         
     for varl, vari in iternodes.iteritems():
-        #build list of parents for current variable
-        parents = predd[varl].keys()
-        parents.append(varl)
-        
-        x = [lut[n] for n in parents]
-        #build a state matrix
-        states = data[:,x]
-        varlcpt = nodedict[varl]['cpt']
-        ll[:,vari] = [varlcpt[tuple(i)] for i in states]
-        print N.any(ll[:,vari]==0)
-    return ll
-    net.score = N.sum(N.log(ll))
+        #log probability of each row for the current variable
+        ll[:,vari] = cpt.family_logprob(net, varl, data)
+    net.score = N.sum(ll)
     return net.score
     
-def itlik(net, data, optimal=-N.inf, nodes=()):
+def itlik(net, data, optimal=-N.inf, nodes=(), weights=None):
     """Iterteravely calculate likelihood
     
     keeps a running sum of likelihood of each node.  
@@ -58,45 +68,502 @@ def itlik(net, data, optimal=-N.inf, nodes=()):
         data            Dataset to use in calculating the log likelihood
         optimal         cutoff value for log likelihood.
         nodes           Nodes to use in calculating the likelihood
+        weights         multiplicity of each row of data (see util.compress)
         
     RETURNS:
         net.score       The log likelihood of the network.
                         Added as an attribute of the network.
     """
-    predd = net.pred
-    nodedict = net.node
     lut = net.graph['nilut']
     likelihood = 0.0
-    nlog = N.log
-    nsum = N.sum
-    results = N.zeros(data.shape[0])
     
     if nodes:
         iternodes = {n:i for n, i in lut.iteritems() if n in nodes or i in nodes}
     else:
         iternodes = lut
     
-    for varl, vari in iternodes.iteritems():
-        parents = predd[varl].keys()
-        parents.append(varl)
-        
-        x = [lut[n] for n in parents]
-        
-        #build a state matrix
-        states = data[:,x]
-        varlcpt = nodedict[varl]['cpt']
-        results[:] = [varlcpt[tuple(i)] for i in states]
-        likelihood += nsum(nlog(results))
-        if likelihood < optimal:
-            likelihood = -N.inf
-            break
+    instrument.count('itlik.rows', data.shape[0])
+    with instrument.timer('itlik'):
+        for varl, vari in iternodes.iteritems():
+            #gather the cached log probabilities of the family (see cpt.logcpt)
+            if weights is None:
+                likelihood += cpt.family_logprob(net, varl, data).sum()
+            else:
+                likelihood += N.dot(cpt.family_logprob(net, varl, data), weights)
+            if likelihood < optimal:
+                likelihood = -N.inf
+                break
     net.score = likelihood
     return net.score
     
-def ll_edges(net, data):
-    for f, e in net.edges():
-        net.edge[f][e] = itlik(net, data, nodes=(f, e))
+def family_counts(data, ids, shape, weights=None):
+    """Counts of the observed configurations of a family
+    
+    PARAMETERS:
+        data    Dataset
+        ids     columns of the family in data (child last)
+        shape   number of states of each column in ids
+        weights multiplicity of each row of data (see util.compress)
+        
+    RETURNS:
+        nijk    count of each observed family configuration
+        parent  index into nij of the parent configuration of each nijk
+        nij     count of each observed parent configuration
+    """
+    states = cpt.as_states(data[:,ids])
+    #only rows where the whole family is observed are counted
+    complete = (states != cpt.MISSING).all(axis=1)
+    if not complete.all():
+        states = states[complete]
+        if weights is not None:
+            weights = weights[complete]
+    keys = N.ravel_multi_index(tuple(states.T), shape)
+    ukeys, inv = N.unique(keys, return_inverse=True)
+    nijk = N.bincount(inv, weights=weights).astype(float)
+    pkeys, parent = N.unique(ukeys // shape[-1], return_inverse=True)
+    nij = N.bincount(parent, weights=nijk)
+    return nijk, parent, nij
+    
+def family_score(nijk, parent, nij, shape, method='bic', m=None, ess=1.0):
+    """Decomposable score of one family from its counts (see family_counts)
+    
+    PARAMETERS:
+        nijk, parent, nij       family counts
+        shape                   number of states of the parents and the child
+        method                  'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+        m                       number of rows (needed by 'bic')
+        ess                     equivalent sample size of 'bdeu'
+        
+    RETURNS:
+        float                   score of the family
+    """
+    r = shape[-1]
+    q = float(N.prod(shape[:-1]))
+    if method in ('loglik', 'bic', 'aic'):
+        ll = N.sum(nijk * (N.log(nijk) - N.log(nij[parent])))
+        if method == 'loglik':
+            return ll
+        nparams = q * (r - 1)
+        if method == 'bic':
+            return ll - .5 * N.log(m) * nparams
+        return ll - nparams
+    elif method == 'k2':
+        gammaln = _gammaln()
+        #unobserved parent configurations contribute 0
+        return (N.sum(gammaln(r) - gammaln(nij + r)) + N.sum(gammaln(nijk + 1)))
+    elif method == 'bdeu':
+        gammaln = _gammaln()
+        a_ij = ess / q
+        a_ijk = ess / (q * r)
+        return (N.sum(gammaln(a_ij) - gammaln(nij + a_ij)) +
+                N.sum(gammaln(nijk + a_ijk) - gammaln(a_ijk)))
+    else:
+        raise ValueError("Unknown score: {0}".format(method))
+
+class FamilyScorer(object):
+    """Decomposable network scores with a cache of family scores.
+    
+    A family (node and parent set) is counted once from data and its score
+    is cached, so scoring many networks over the same data only counts the
+    families that have not been seen yet.  All scores come from the same
+    counts, so switching the score costs no extra pass over the data.
+    """
+    
+    def __init__(self, net, data, method='bic', ess=1.0, weights=None):
+        """
+        PARAMETERS:
+            net         A bayesian network providing the lookup table and the
+                        nstates of each node (taken from data if missing)
+            data        Dataset (columns ordered by the network's lookup table)
+            method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+            ess         equivalent sample size of 'bdeu'
+            weights     multiplicity of each row of data (see util.compress)
+            
+        RETURNS:
+            instance of FamilyScorer
+        """
+        if method not in SCORES:
+            raise ValueError("Unknown score: {0}".format(method))
+        self.data = data
+        self.method = method
+        self.ess = ess
+        self.weights = None if weights is None else N.asarray(weights)
+        #number of rows the data stands for
+        self.m = data.shape[0] if weights is None else self.weights.sum()
+        self.nilut = dict(net.graph['nilut'])
+        self.nstates = {}
+        for node, i in self.nilut.iteritems():
+            nstates = net.node[node].get('nstates', None)
+            self.nstates[node] = int(cpt.as_states(data[:,i]).max()) + 1 if nstates is None else nstates
+        self.cache = {}
+        
+    def family(self, node, parents):
+        """Score of node with the given parents"""
+        parents = tuple(sorted(parents))
+        key = (node, parents)
+        value = self.cache.get(key, None)
+        instrument.cache('family', value is not None)
+        if value is None:
+            family = parents + (node,)
+            shape = [self.nstates[x] for x in family]
+            with instrument.timer('family'):
+                nijk, parent, nij = family_counts(self.data, [self.nilut[x] for x in family], shape, self.weights)
+                value = family_score(nijk, parent, nij, shape, self.method, self.m, self.ess)
+            self.cache[key] = value
+        return value
+        
+    def score(self, net, optimal=-N.inf):
+        """Score a network.  Sets net.score.
+        
+        PARAMETERS:
+            net         A bayesian network over the scorer's nodes
+            optimal     cutoff value.  Scoring stops with -inf as soon as the
+                        running sum drops below it.
+            
+        RETURNS:
+            net.score
+        """
+        total = 0.0
+        for node in self.nilut:
+            total += self.family(node, net.pred[node])
+            if total < optimal:
+                total = -N.inf
+                break
+        net.score = total
+        return net.score
+        
+    def prefetch(self, families, processes=None):
+        """Count and score the families not in the cache yet
+        
+        PARAMETERS:
+            families    iterable of (node, parents) pairs
+            processes   number of worker processes (None or 1 scores in this
+                        process)
+                        
+        RETURNS:
+            None
+        """
+        families = list(families)
+        new = list(set(key for key in ((node, tuple(sorted(parents))) for node, parents in families)
+                       if key not in self.cache))
+        instrument.count('family.batch', len(families))
+        instrument.count('family.unique', len(new))
+        
+        if processes > 1 and len(new) > 1:
+            jobs = [([self.nilut[x] for x in parents + (node,)], [self.nstates[x] for x in parents + (node,)])
+                    for node, parents in new]
+            pool = multiprocessing.Pool(processes, _init_family_worker,
+                                        (self.data, self.method, self.ess, self.weights, self.m))
+            try:
+                with instrument.timer('family'):
+                    values = pool.map(_score_family, jobs, chunksize=max(1, len(jobs) // (4*processes)))
+            finally:
+                pool.terminate()
+            self.cache.update(zip(new, values))
+        else:
+            for node, parents in new:
+                self.family(node, parents)
+                
+    def _parent_sets(self, net):
+        """Parents of each node of a Network or of an iterable of edges"""
+        if hasattr(net, 'pred'):
+            return dict((node, net.pred[node]) for node in self.nilut)
+        parents = dict((node, []) for node in self.nilut)
+        for u, v in net:
+            parents[v].append(u)
+        return parents
+        
+    def score_many(self, nets, processes=None):
+        """Score many networks, counting each distinct family once
+        
+        The families of all networks are collected first, so a family shared
+        by several networks is counted and scored once.  Families not yet in
+        the cache can be scored by a pool of worker processes.
+        
+        PARAMETERS:
+            nets        list of Networks or of edge lists [(parent, child), ...]
+                        over the scorer's nodes
+            processes   number of worker processes (None or 1 scores in this
+                        process)
+            
+        RETURNS:
+            scores      array of the score of each network.  Sets the score of
+                        each Network.
+        """
+        families = []
+        for net in nets:
+            families.append([(node, tuple(sorted(parents))) for node, parents in self._parent_sets(net).iteritems()])
+        self.prefetch([key for fam in families for key in fam], processes)
+        
+        scores = N.array([sum(self.cache[key] for key in fam) for fam in families])
+        for net, value in zip(nets, scores):
+            if hasattr(net, 'pred'):
+                net.score = value
+        return scores
+        
+#data of the family scoring workers of FamilyScorer.score_many
+_worker = {}
+
+def _init_family_worker(data, method, ess, weights, m):
+    _worker.update(data=data, method=method, ess=ess, weights=weights, m=m)
+    
+def _score_family(job):
+    ids, shape = job
+    nijk, parent, nij = family_counts(_worker['data'], ids, shape, _worker['weights'])
+    return family_score(nijk, parent, nij, shape, _worker['method'], _worker['m'], _worker['ess'])
+    
+#scores RacingScorer can estimate from a subsample
+RACING_SCORES = ('loglik', 'bic', 'aic')
+
+class RacingScorer(object):
+    """Scorer that rejects hopeless networks on row subsamples first
+    
+    A network is scored on growing random subsamples (stages) before the
+    full data.  From a subsample of s rows the score is estimated as m times
+    the mean row log likelihood, with a standard error bounded by the sum of
+    the standard deviations of the family terms.  If the estimate plus z
+    standard errors is still below the cutoff, the network is rejected with
+    a score of -inf without touching the full data.  The in-sample estimate
+    is optimistic, which makes rejections conservative.
+    
+    Only 'loglik', 'bic' and 'aic' are raced, other scores go straight to
+    the full data.
+    """
+    
+    def __init__(self, net, data, method='loglik', ess=1.0, weights=None, stages=(.01, .1),
+                 z=3.0, min_rows=200, rand=None):
+        """
+        PARAMETERS:
+            net         A bayesian network (see FamilyScorer)
+            data        Dataset
+            method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+            ess         equivalent sample size of 'bdeu'
+            weights     multiplicity of each row of data (see util.compress)
+            stages      subsample sizes, as fractions of the rows
+            z           number of standard errors of the rejection bound
+            min_rows    smallest subsample worth racing on
+            rand        numpy RandomState drawing the subsamples
+            
+        RETURNS:
+            instance of RacingScorer
+        """
+        self.full = FamilyScorer(net, data, method, ess, weights)
+        self.cache = self.full.cache
+        self.nstates = self.full.nstates
+        self.method = method
+        self.z = z
+        rand = N.random if rand is None else rand
+        
+        nrows = data.shape[0]
+        p = None if weights is None else self.full.weights / float(self.full.weights.sum())
+        self.stages = []
+        for fraction in stages:
+            size = int(self.full.m * fraction)
+            if size < min_rows or size >= nrows:
+                continue
+            rows = N.sort(rand.choice(nrows, size, replace=p is not None, p=p))
+            self.stages.append((data[rows], {}))
+            
+    def _family_stats(self, stage, node, parents):
+        """Mean and variance of the per row log likelihood term of a family"""
+        sample, cache = stage
+        key = (node, tuple(sorted(parents)))
+        value = cache.get(key, None)
+        if value is None:
+            family = key[1] + (node,)
+            shape = [self.full.nstates[x] for x in family]
+            nijk, parent, nij = family_counts(sample, [self.full.nilut[x] for x in family], shape)
+            terms = N.log(nijk) - N.log(nij[parent])
+            s = float(sample.shape[0])
+            mean = N.sum(nijk * terms) / s
+            value = mean, max(N.sum(nijk * terms**2) / s - mean**2, 0.)
+            cache[key] = value
+        return value
+        
+    def _penalty(self, net):
+        """Parameter penalty of bic/aic on the full data"""
+        if self.method == 'loglik':
+            return 0.
+        nparams = 0.
+        for node in self.full.nilut:
+            q = N.prod([self.full.nstates[x] for x in net.pred[node]])
+            nparams += q * (self.full.nstates[node] - 1)
+        if self.method == 'bic':
+            return .5 * N.log(self.full.m) * nparams
+        return nparams
+        
+    def score(self, net, optimal=-N.inf):
+        """Score a network, racing it against optimal.  Sets net.score.
+        
+        RETURNS:
+            net.score   -inf if the network was rejected on a subsample or
+                        fell below optimal on the full data
+        """
+        if optimal > -N.inf and self.method in RACING_SCORES:
+            penalty = self._penalty(net)
+            for k, stage in enumerate(self.stages):
+                mean, sd = 0., 0.
+                for node in self.full.nilut:
+                    mu, var = self._family_stats(stage, node, net.pred[node])
+                    mean += mu
+                    sd += N.sqrt(var)
+                s = stage[0].shape[0]
+                bound = self.full.m * (mean + self.z * sd / N.sqrt(s)) - penalty
+                if bound < optimal:
+                    instrument.count('race.rejected.{0}'.format(k))
+                    net.score = -N.inf
+                    return net.score
+        instrument.count('race.full')
+        return self.full.score(net, optimal)
+        
+    def score_many(self, nets, processes=None):
+        """Score many networks on the full data (see FamilyScorer.score_many)"""
+        return self.full.score_many(nets, processes)
+        
+def batch_score(nets, data, method='bic', ess=1.0, processes=None, net=None, weights=None):
+    """Score many networks over the same data (see FamilyScorer.score_many)
+    
+    PARAMETERS:
+        nets        list of Networks or of edge lists [(parent, child), ...]
+        data        Dataset
+        method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+        ess         equivalent sample size of 'bdeu'
+        processes   number of worker processes
+        net         network providing the nodes and their nstates
+                    (default the first of nets, which must then be a Network)
+        weights     multiplicity of each row of data (see util.compress)
+        
+    RETURNS:
+        scores      array of the score of each network
+    """
+    scorer = FamilyScorer(nets[0] if net is None else net, data, method, ess, weights)
+    return scorer.score_many(nets, processes)
+    
+def network_score(net, data, method='bic', optimal=-N.inf, ess=1.0, weights=None):
+    """Score a network with a decomposable score (see FamilyScorer)
+    
+    PARAMETERS:
+        net         A bayesian network
+        data        Dataset
+        method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+        optimal     cutoff value for the score
+        ess         equivalent sample size of 'bdeu'
+        weights     multiplicity of each row of data (see util.compress)
+        
+    RETURNS:
+        net.score   The score of the network.
+    """
+    return FamilyScorer(net, data, method, ess, weights).score(net, optimal)
+    
+def edge_strength(net, data, method='loglik', ess=1.0, processes=None, scorer=None, attr='strength'):
+    """Strength of each edge: the score lost by removing it
+    
+    Only the child's family changes when an edge is removed, so the strength
+    of u->v is family(v, parents) - family(v, parents - u).  Each distinct
+    family is counted once (in parallel with processes) and the results are
+    stored as the edge attribute attr.
+    
+    PARAMETERS:
+        net         A bayesian network
+        data        Dataset
+        method      'loglik', 'bic', 'aic', 'bdeu' or 'k2'
+        ess         equivalent sample size of 'bdeu'
+        processes   number of worker processes
+        scorer      FamilyScorer to reuse (its cached families are not recounted)
+        attr        name of the edge attribute
+        
+    RETURNS:
+        strengths   dict mapping each edge (u, v) to its strength
+    """
+    if scorer is None:
+        scorer = FamilyScorer(net, data, method, ess)
+    edges = net.edges()
+    families = []
+    for u, v in edges:
+        parents = tuple(net.pred[v])
+        families.append((v, parents))
+        families.append((v, tuple(p for p in parents if p != u)))
+    with instrument.timer('edge_strength'):
+        scorer.prefetch(families, processes)
+    
+    strengths = {}
+    for u, v in edges:
+        parents = tuple(net.pred[v])
+        strengths[u, v] = scorer.family(v, parents) - scorer.family(v, [p for p in parents if p != u])
+        net.edge[u][v][attr] = strengths[u, v]
+    return strengths
+    
+def ll_edges(net, data, processes=None):
+    """Log likelihood strength of each edge (see edge_strength)"""
+    return edge_strength(net, data, 'loglik', processes=processes, attr='loglik')
         
 def ll_edges2(net, data, edge):
     nodes = util.all_parents(net, edge)
-    return itlik(net, data, nodes=nodes)
\ No newline at end of file
+    return itlik(net, data, nodes=nodes)
+    
+def mutual_information(net, data):
+    """Pairwise mutual information between the variables of data
+    
+    One bincount per variable computes its joint counts with every other
+    variable at once.
+    
+    PARAMETERS:
+        net     A bayesian network (provides nstates of each node)
+        data    Dataset (columns ordered by the network's lookup table)
+        
+    RETURNS:
+        ndarray     (n, n) symmetric matrix of mutual information (nats)
+    """
+    X = cpt.as_states(data)
+    m, n = X.shape
+    inlut = net.graph['inlut']
+    r = N.array([net.node[inlut[i]]['nstates'] for i in xrange(n)])
+    rmax = r.max()
+    
+    #missing values get their own (ignored) state past the real ones
+    X = N.where(X == cpt.MISSING, rmax, X)
+    rmax += 1
+    
+    #marginal distributions padded to rmax states
+    marg = N.zeros((n, rmax))
+    for i in xrange(n):
+        marg[i,:r[i]] = N.bincount(X[:,i], minlength=rmax)[:r[i]] / float(m)
+    
+    mi = N.zeros((n, n))
+    offsets = N.arange(n) * rmax
+    with instrument.timer('mutual_information'):
+        for i in xrange(n):
+            #code = state of i, variable j, state of j
+            codes = X[:,i:i+1] * (n*rmax) + offsets + X
+            joint = N.bincount(codes.ravel(), minlength=rmax*n*rmax).reshape((rmax, n, rmax))[:r[i]] / float(m)
+            joint[:,:,-1] = 0.
+            expected = marg[i,:r[i],None,None] * marg[None,:,:]
+            seen = joint > 0
+            terms = N.zeros(joint.shape)
+            terms[seen] = joint[seen] * N.log(joint[seen] / expected[seen])
+            mi[i] = terms.sum(axis=2).sum(axis=0)
+    N.fill_diagonal(mi, 0.)
+    return mi
+    
+def candidate_parents(net, data, k):
+    """Pre-select the k candidate parents of each node by mutual information
+    
+    The result is stored in net.graph['candidate_parents'], where the
+    learners and random network generators pick it up (see
+    Network.edge_allowed).
+    
+    PARAMETERS:
+        net     A bayesian network
+        data    Dataset (columns ordered by the network's lookup table)
+        k       number of candidate parents per node
+        
+    RETURNS:
+        candidates      dict mapping each node to a tuple of candidate parents
+    """
+    mi = mutual_information(net, data)
+    inlut = net.graph['inlut']
+    N.fill_diagonal(mi, -N.inf)
+    best = N.argsort(-mi, axis=0)[:k]
+    candidates = {inlut[j]:tuple(inlut[i] for i in best[:,j] if i != j) for j in xrange(mi.shape[0])}
+    net.graph['candidate_parents'] = candidates
+    return candidates
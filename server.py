@@ -0,0 +1,262 @@
+"""
+Long running scoring service that keeps fitted networks warm in memory.
+
+Clients connect over a Unix socket (or localhost TCP) and send one JSON
+request per line:
+
+    {"model": "claims", "records": [{"age": "30-40", "amount": 1200.0}, ...]}
+
+and get one JSON response per line:
+
+    {"logprob": [-12.3, ...]}            or      {"error": "..."}
+
+Records from concurrent connections are queued and scored together with one
+Network.logprob call per model: the batcher takes whatever is queued when it
+becomes free and waits at most the latency budget for more.  Models are
+pickled networks (see save_model); a file that changes on disk is reloaded
+and swapped in between batches, so no request is dropped.
+
+    python server.py --socket /tmp/bnet.sock claims=claims.pkl
+"""
+
+import os
+import sys
+import time
+import json
+import Queue
+import argparse
+import threading
+import SocketServer
+import cPickle as pickle
+import numpy as N
+
+import cpt
+import reader
+import discretize
+import instrument
+
+def save_model(net, filename):
+    """Pickle a fitted network for the server.  The file is replaced
+    atomically, so a running server never loads a partial model."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(net, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
+
+def load_model(filename):
+    """Load a pickled network and build its log probability tables"""
+    with open(filename, 'rb') as f:
+        net = pickle.load(f)
+    for node in net.nodes():
+        cpt.logcpt(net, node)
+    return net
+
+def encode_record(net, record):
+    """State indexes of a record (dict of raw values by node)
+
+    Absent or missing values are encoded as cpt.MISSING, continuous values
+    are binned with the node's edges.  Unknown states raise a KeyError.
+    """
+    row = N.empty(len(net.graph['nilut']))
+    for node, i in net.graph['nilut'].iteritems():
+        value = record.get(node, None)
+        d = net.node[node]
+        if value is None or str(value) in reader.MISSING_VALUES:
+            row[i] = cpt.MISSING
+        elif 'edges' in d:
+            row[i] = discretize.apply([float(value)], d['edges'])[0]
+        else:
+            row[i] = d['states_ind'][str(value)]
+    return row
+
+class Model(object):
+    """A network loaded from a file, reloaded when the file changes"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        self.net = load_model(filename)
+
+    def refresh(self):
+        """Reload the network if its file changed.  Returns True on reload"""
+        mtime = os.path.getmtime(self.filename)
+        if mtime == self.mtime:
+            return False
+        net = load_model(self.filename)
+        #swap in one assignment, batches already running keep the old network
+        self.net, self.mtime = net, mtime
+        return True
+
+class _Pending(object):
+    __slots__ = ('net', 'rows', 'done', 'result', 'error')
+
+    def __init__(self, net, rows):
+        #the network the rows were encoded with, a reload must not change it
+        self.net = net
+        self.rows = rows
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Batcher(threading.Thread):
+    """Group queued requests into one logprob call per network
+
+    A batch takes every request already queued, up to maxbatch rows, then
+    waits for more at most latency seconds from when the batcher picked up
+    its first request.
+    """
+
+    def __init__(self, latency=.0005, maxbatch=4096, marginalize=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.latency = latency
+        self.maxbatch = maxbatch
+        self.marginalize = marginalize
+        self.queue = Queue.Queue()
+
+    def submit(self, net, rows):
+        """Queue rows encoded with net for scoring and wait for their log
+        probabilities"""
+        pending = _Pending(net, rows)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            nrows = batch[0].rows.shape[0]
+            #a backlog built up while the last batch was scored is always
+            #taken, the deadline only bounds waiting for new requests
+            deadline = time.time() + self.latency
+            while nrows < self.maxbatch:
+                try:
+                    pending = self.queue.get_nowait()
+                except Queue.Empty:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending = self.queue.get(timeout=timeout)
+                    except Queue.Empty:
+                        break
+                batch.append(pending)
+                nrows += pending.rows.shape[0]
+            self._score(batch)
+
+    def _score(self, batch):
+        #group by network object: a reloaded model is a different network
+        bynet = {}
+        for pending in batch:
+            bynet.setdefault(id(pending.net), []).append(pending)
+        for group in bynet.itervalues():
+            try:
+                net = group[0].net
+                rows = N.concatenate([p.rows for p in group])
+                instrument.count('server.rows', rows.shape[0])
+                with instrument.timer('server'):
+                    logprobs = net.logprob(rows, self.marginalize)
+                start = 0
+                for p in group:
+                    p.result = logprobs[start:start+p.rows.shape[0]]
+                    start += p.rows.shape[0]
+            except Exception as e:
+                for p in group:
+                    p.error = e
+            for p in group:
+                p.done.set()
+
+class Handler(SocketServer.StreamRequestHandler):
+    """One JSON request per line, one JSON response per line"""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                name = request['model']
+                records = request.get('records', None)
+                if records is None:
+                    records = [request['record']]
+                net = self.server.models[name].net
+                rows = N.array([encode_record(net, r) for r in records]).reshape((len(records), -1))
+                result = self.server.batcher.submit(net, rows)
+                response = {'logprob': result.tolist()}
+            except Exception as e:
+                response = {'error': "{0}: {1}".format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(models, address, latency=.0005, maxbatch=4096, marginalize=False):
+    """Create (but do not start) a scoring server
+
+    PARAMETERS:
+        models      dict mapping model names to pickled network files
+        address     path of a Unix socket or a (host, port) tuple
+        latency     seconds a request may wait while its batch keeps filling
+        maxbatch    maximum number of rows scored at once
+        marginalize sum out missing values (see Network.logprob)
+
+    RETURNS:
+        server      SocketServer instance with models and batcher attributes
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixServer(address, Handler)
+    else:
+        server = _TCPServer(address, Handler)
+    server.models = {name:Model(filename) for name, filename in models.iteritems()}
+    server.batcher = Batcher(latency, maxbatch, marginalize)
+    server.batcher.start()
+    return server
+
+def watch(models, interval=1.0):
+    """Reload changed model files every interval seconds (runs forever)"""
+    while True:
+        time.sleep(interval)
+        for name, model in models.iteritems():
+            try:
+                if model.refresh():
+                    instrument.progress('server.reload', model=name, filename=model.filename)
+            except Exception as e:
+                #keep serving the previous version
+                instrument.progress('server.reload_failed', model=name, error=e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve fitted networks for scoring")
+    parser.add_argument('models', nargs='+', help="name=file.pkl")
+    parser.add_argument('--socket', help="path of the Unix socket")
+    parser.add_argument('--port', type=int, default=8765, help="localhost port if no socket is given")
+    parser.add_argument('--latency', type=float, default=.0005,
+                        help="longest wait of a request while its batch keeps filling (seconds)")
+    parser.add_argument('--maxbatch', type=int, default=4096)
+    parser.add_argument('--reload', type=float, default=1.0, help="seconds between model file checks")
+    parser.add_argument('--marginalize', action='store_true', help="sum out missing values")
+    args = parser.parse_args(argv)
+
+    models = dict(m.split('=', 1) for m in args.models)
+    address = args.socket or ('127.0.0.1', args.port)
+    server = make_server(models, address, args.latency, args.maxbatch, args.marginalize)
+
+    watcher = threading.Thread(target=watch, args=(server.models, args.reload))
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+"""
+Import budget of the core modules (see bench.import_time).
+
+    python -m unittest test_imports
+"""
+
+import unittest
+
+import bench
+
+class ImportTest(unittest.TestCase):
+
+    def test_core_imports(self):
+        seconds, heavy = bench.import_time()
+        self.assertEqual(bench.check_imports({'time': seconds, 'heavy': heavy}), [])
+
+if __name__ == '__main__':
+    unittest.main()
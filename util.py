@@ -1,10 +1,20 @@
+import os
+import zlib
+import json
 import network
+import reader
+import cpt
+import discretize
 import numpy as N
 import random
+import instrument
 
 def all_parents(net, nodes):
     """
-    Return a set of immediate parent nodes of a set of nodes.
+    Return the set of nodes and all their ancestors.
+    
+    Uses the ancestor bitsets maintained by the network (see
+    Network.ancestor_bits) instead of walking up the parents.
     
     PARAMETERS:
         net     A bayesian network
@@ -13,12 +23,45 @@ def all_parents(net, nodes):
     RETURNS:
         parentset       A set of all parents
     """
-    if nodes:
-        parentset = set(nodes)
-        return parentset.union(*[all_parents(net, net.predecessors(node)) for node in nodes])
-    else:
-        return set()
+    nilut = net.graph['nilut']
+    bits = 0
+    for node in nodes:
+        bits |= (1 << nilut[node]) | net.ancestor_bits(node)
+    return set(net.nodes_of(bits))
         
+def compress(data):
+    """Collapse a dataset to its distinct rows
+    
+    Counting and scoring functions take the patterns with weights=weights;
+    per row results are expanded back with expand(values, inverse).
+    
+    PARAMETERS:
+        data        A dataset (2d numpy array)
+        
+    RETURNS:
+        patterns    distinct rows of data (sorted)
+        weights     number of times each pattern occurs
+        inverse     index of the pattern of each row of data
+    """
+    data = N.atleast_2d(data)
+    with instrument.timer('compress'):
+        order = N.lexsort(data.T[::-1])
+        rows = data[order]
+        first = N.ones(rows.shape[0], dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]).any(axis=1)
+        group = N.cumsum(first) - 1
+        patterns = rows[first]
+        weights = N.bincount(group)
+        inverse = N.empty(data.shape[0], dtype=int)
+        inverse[order] = group
+    instrument.count('compress.rows', data.shape[0])
+    instrument.count('compress.patterns', patterns.shape[0])
+    return patterns, weights, inverse
+    
+def expand(values, inverse):
+    """Per row values from per pattern values (see compress)"""
+    return N.asarray(values)[inverse]
+    
 def genRandObs(net, nobs, numeric=True):
     """generate valid random observations for net
     
@@ -47,7 +90,116 @@ def genRandObs(net, nobs, numeric=True):
         obslist.append(ob)
     return obslist
     
-def suspect(net, data, threshold=.01, output=None):
+class ScoreStore(object):
+    """Per row, per node log probability contributions kept on disk
+    
+    The contributions live in a memory mapped (rows, nodes+1) matrix whose
+    last column holds the row totals.  Each node column is stamped with its
+    current parents and a checksum of its log probability table, so after a model
+    update only the columns of refitted or rewired families are recomputed
+    and the totals are adjusted by the difference.  The stamps are saved
+    next to the matrix (filename + '.json'), so a store can be reopened by a
+    later run over the same data.
+    """
+    
+    def __init__(self, net, data, filename=None, blocksize=2**20):
+        """
+        PARAMETERS:
+            net         A bayesian network
+            data        Dataset scored by the store (rows must not change)
+            filename    matrix file (default keep the matrix in memory)
+            blocksize   rows scored at once
+            
+        RETURNS:
+            instance of ScoreStore
+        """
+        self.net = net
+        self.data = data
+        self.filename = filename
+        self.blocksize = blocksize
+        m, n = data.shape[0], len(net.graph['nilut'])
+        self.stamps = {}
+        if filename is None:
+            self.matrix = N.zeros((m, n+1), order='F')
+        elif os.path.exists(filename) and os.path.exists(filename + '.json'):
+            with open(filename + '.json', 'rb') as f:
+                meta = json.load(f)
+            if meta['shape'] != [m, n+1]:
+                raise ValueError("{0} holds scores of shape {1}".format(filename, meta['shape']))
+            self.matrix = N.memmap(filename, dtype=float, mode='r+', shape=(m, n+1), order='F')
+            self.stamps = {int(i): tuple(stamp) for i, stamp in meta['stamps'].iteritems()}
+        else:
+            self.matrix = N.memmap(filename, dtype=float, mode='w+', shape=(m, n+1), order='F')
+        
+    def _stamp(self, node):
+        """Current family (lut ids, parents sorted) and checksum of the log
+        probability table of node"""
+        nilut = self.net.graph['nilut']
+        table = cpt.logcpt(self.net, node)
+        if isinstance(table, cpt.SparseLogCPT):
+            crc = 0
+            for part in (table.keys, table.values, table.pkeys, table.pvalues, N.array([table.default])):
+                crc = zlib.crc32(part.tostring(), crc)
+        else:
+            crc = zlib.crc32(N.ascontiguousarray(table).tostring())
+        return (sorted(nilut[x] for x in self.net.pred[node]) + [nilut[node]], crc)
+        
+    def update(self):
+        """Recompute the columns of the families that changed
+        
+        RETURNS:
+            list        nodes whose contributions were recomputed
+        """
+        changed = []
+        total = self.matrix[:,-1]
+        for node, i in self.net.graph['nilut'].iteritems():
+            stamp = self._stamp(node)
+            if list(self.stamps.get(i, ())) == list(stamp):
+                continue
+            with instrument.timer('scorestore'):
+                for start in xrange(0, self.data.shape[0], self.blocksize):
+                    rows = slice(start, start + self.blocksize)
+                    column = cpt.family_logprob(self.net, node, self.data[rows])
+                    total[rows] += column - self.matrix[rows,i]
+                    self.matrix[rows,i] = column
+            instrument.count('scorestore.rows', self.data.shape[0])
+            self.stamps[i] = stamp
+            changed.append(node)
+        if changed:
+            self.flush()
+        return changed
+        
+    def flush(self):
+        """Write the matrix and the stamps to disk"""
+        if self.filename is None:
+            return
+        self.matrix.flush()
+        tmp = self.filename + '.json.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump({'shape': list(self.matrix.shape),
+                       'stamps': {str(i): list(stamp) for i, stamp in self.stamps.iteritems()}}, f)
+        os.rename(tmp, self.filename + '.json')
+        
+    def totals(self):
+        """Log joint probability of each row (up to date after update)"""
+        return self.matrix[:,-1]
+        
+    def contrib(self, rows=None):
+        """Contributions of each node (columns by lut id) for rows"""
+        if rows is None:
+            return self.matrix[:,:-1]
+        return self.matrix[rows,:-1]
+        
+    def top(self, k):
+        """Indexes of the k least likely rows, least likely first"""
+        totals = self.totals()
+        k = min(k, totals.size)
+        if k <= 0:
+            return N.zeros(0, dtype=int)
+        lowest = N.argpartition(totals, k-1)[:k]
+        return lowest[N.argsort(totals[lowest], kind='mergesort')]
+        
+def suspect(net, data, threshold=.01, output=None, explain=0, store=None):
     """
     Find the most suspicious claims from jointprobs
     
@@ -56,22 +208,43 @@ def suspect(net, data, threshold=.01, output=None):
         data            A dataset
         threshold=.01   Bottom threshold.  Default is least likely 1% of claims
         output=None     Optionally output to a file
+        explain=0       Number of most surprising variables to report for
+                        each suspected claim
+        store=None      ScoreStore over data.  Only the families changed
+                        since its last update are rescored.
         
     RETURNS:
         suspected       The suspected claims
         sortedind       The indices of the suspect claims in original dataset
+        
+        if explain > 0 the following are returned as well
+        contrib         Log probability contribution of each node for each
+                        suspected claim (columns ordered by node index)
+        surprising      Node indexes of the explain lowest contributions of
+                        each suspected claim, most surprising first
     """
-    jointprobs = net.jointprob(data)
-    nprobs = jointprobs.shape[0]
-    sortedind = N.argsort(jointprobs[:,-1].astype(float))
+    if store is not None:
+        store.update()
+        logprobs = N.array(store.totals())
+    else:
+        logprobs = net.logprob(data)
+    nprobs = logprobs.shape[0]
+    sortedind = N.argsort(logprobs)
     suspicious = int(nprobs*threshold)
-    print suspicious
+    instrument.progress('suspect', rows=nprobs, flagged=abs(suspicious))
     if suspicious >= 0:
-        suspected = (jointprobs[sortedind])[:suspicious]
         sortedind = sortedind[:suspicious]
     else:
-        suspected = (jointprobs[sortedind])[suspicious:]
         sortedind = sortedind[suspicious:]
+    suspected = N.c_[data[sortedind], logprobs[sortedind]]
+    
+    #only the suspected rows are broken down into per node contributions
+    if explain > 0:
+        if store is not None:
+            contrib = N.array(store.contrib(sortedind))
+        else:
+            contrib = net.logcontrib(data[sortedind])
+        surprising = N.argsort(contrib, axis=1)[:,:explain]
     
     suspect_names = []
     _inlut = net.graph['inlut']
@@ -79,42 +252,111 @@ def suspect(net, data, threshold=.01, output=None):
     for row in xrange(m):
         s_row = []
         for col in xrange(n):
-            s_row.append(net.node[_inlut[col]]['ind_states'][suspected[row,col]])
+            #missing values are written as empty fields
+            s_row.append(net.node[_inlut[col]]['ind_states'].get(suspected[row,col], ''))
         s_row.append(str(suspected[row, col+1]))
+        if explain > 0:
+            for col in surprising[row]:
+                s_row.extend([str(_inlut[col]), str(contrib[row, col])])
         suspect_names.append(s_row)
         
     if output is not None:
+        header = net.ordering+["log prob"]
+        for rank in xrange(1, explain+1):
+            header.extend(["surprise {0}".format(rank), "surprise {0} log prob".format(rank)])
         with open(output, 'wb') as f:
-            f.write(','.join([str(char) for char in net.ordering+["log prob"]]))
+            f.write(','.join([str(char) for char in header]))
             f.write('\n')
             for obs in suspect_names:
-                f.write(','.join([o for o in obs]))
+                f.write(','.join([str(o) for o in obs]))
                 f.write('\n')
     
+    if explain > 0:
+        return suspected, sortedind, contrib, surprising
     return suspected, sortedind
 
-def load_dataset(net, filename):
+def load_dataset(net, filename, missing=reader.MISSING_VALUES):
     """Turn a dataset into corresponding state indexes for network
     
     PARAMETERS:
         net             A bayesian network
         filename        file from which to load dataset
+        missing         values encoded as missing (cpt.MISSING)
         
     RETURNS:
         numberdata      values of dataset in a numpy array
     """    
     
-    data = N.recfromcsv(filename, delimiter=",", names=True, autostrip=True, case_sensitive=True)
+    with instrument.timer('load'):
+        data = N.recfromcsv(filename, delimiter=",", names=True, autostrip=True, case_sensitive=True, usemask=True)
+    instrument.count('load.rows', data.size)
 
     m, n = data.size, len(data.dtype.names)
     numberdata = N.zeros((m, n), order='F')
     
     for node, d in net.node.iteritems():
-        states = d['states_ind']
-        numberdata[:,net.graph['nilut'][node]] = [states[str(s)] for s in data[node]]
+        if 'edges' in d:
+            #continuous column, binned like the data the network was built from
+            numberdata[:,net.graph['nilut'][node]] = discretize.apply(reader.numeric(data[node], missing), d['edges'])
+        else:
+            numberdata[:,net.graph['nilut'][node]] = reader.encode(data[node], d['states_ind'], missing)
         
+    if cpt.COMPACT:
+        numberdata = cpt.compact_states(numberdata, max(d['nstates'] for d in net.node.itervalues()))
     return numberdata
     
+def fit_csv(net, source, chunksize=10000, missing=reader.MISSING_VALUES, sparse=False,
+            prior=None, alpha=1.0, grow=True):
+    """Fit the CPTs of net from a csv file without loading it whole
+    
+    Each chunk is encoded with the nodes' states_ind (continuous nodes with
+    their edges), counted into the tables and dropped, so memory is bounded
+    by one chunk plus the tables.  Values are named as csv2bnet names the
+    states of the column a node was loaded from (see reader.as_loaded).
+    Counts accumulate on top of any counts already on the nodes.
+    
+    PARAMETERS:
+        net             A bayesian network
+        source          csv file name, or an iterable of chunks mapping each
+                        node to a column of raw values (e.g. record arrays)
+        chunksize       rows per chunk when reading a file
+        missing         values encoded as missing (cpt.MISSING)
+        sparse          count into sparse tables (see cpt.cpt)
+        prior, alpha    pseudo-counts of the log probability tables
+        grow            add states first seen in a chunk (the tables are
+                        enlarged); otherwise unknown states raise KeyError
+        
+    RETURNS:
+        rows            number of rows counted
+    """
+    if isinstance(source, str):
+        source = reader.read_chunks(source, chunksize)
+    nilut = net.graph['nilut']
+    kinds = {node: reader.column_kind(net, node) for node in nilut}
+    if grow:
+        for d in net.node.itervalues():
+            if 'edges' not in d and 'states_ind' not in d:
+                d['nstates'] = 0
+    
+    rows = 0
+    for chunk in source:
+        m = len(chunk[nilut.keys()[0]])
+        data = N.zeros((m, len(nilut)), order='F')
+        for node, i in nilut.iteritems():
+            d = net.node[node]
+            if 'edges' in d:
+                data[:,i] = discretize.apply(reader.numeric(chunk[node], missing), d['edges'])
+            else:
+                column = reader.as_loaded(chunk[node], kinds[node], missing)
+                if grow:
+                    reader.extend_states(net, node, column, missing)
+                data[:,i] = reader.encode(column, d['states_ind'], missing)
+        cpt.cpt(net, data, sparse=sparse, prior=prior, alpha=alpha)
+        rows += m
+        instrument.progress('fit.chunk', rows=rows)
+        del data
+    return rows
+    
 def clearCPT(net):
     """Clear the CPT tables of each node in net
     
@@ -126,12 +368,11 @@ def clearCPT(net):
     """
     
     for d in net.node.itervalues():
-        if 'numer' in d:
-            del d['numer']
-        if 'denom' in d:
-            del d['denom']
-        if 'cpt' in d:
-            del d['cpt']
+        for key in ('cptdim', 'numer', 'denom', 'cpt', 'sparse', 'logcpt', 'logcpt_version', 'probcpt', 'probcpt_version'):
+            if key in d:
+                del d[key]
+        #anything cached from the old counts is now stale
+        d['version'] = d.get('version', 0) + 1
 
 def ajustRandom(net, dataset, obs=.25, vars=.1):
     """Adjust random parts of random observations